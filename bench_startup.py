@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Measure startup time of packer.py and fail if its overhead over a bare interpreter exceeds the target.
+
+usage: bench_startup.py [RUNS] [TARGET_MS]
+"""
+
+import sys, os, subprocess, tempfile, time, statistics, py_compile
+
+
+def measure(cmd, runs, cwd, env):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.check_call(cmd, cwd=cwd, env=env, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    target = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.030
+    packer = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'packer.py')
+    # bytecode of packerlib as make install leaves it, also when PYTHONDONTWRITEBYTECODE is set
+    py_compile.compile(os.path.join(os.path.dirname(packer), 'packerlib.py'))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, XDG_CACHE_HOME=os.path.join(tmp, 'cache'))
+        with open(os.path.join(tmp, '1.txt'), 'w') as f:
+            f.write('hello\n')
+        subprocess.check_call([sys.executable, packer, '1.txt', '--to', '1.tar.gz'], cwd=tmp, env=env)
+
+        base = measure([sys.executable, '-c', 'pass'], runs, tmp, env)
+        cases = [
+            ('pack', ['1.txt', '--format', 'gz', '--dry-run']),
+            ('unpack', ['-x', '1.tar.gz', '--to', 'out', '--dry-run']),
+            ('list', ['--list', '1.tar.gz']),
+        ]
+        failed = False
+        print('python startup: {:.1f}ms'.format(base * 1000))
+        for name, argv in cases:
+            t = measure([sys.executable, packer] + argv, runs, tmp, env)
+            overhead = t - base
+            ok = overhead <= target
+            failed = failed or not ok
+            print('{:8} {:.1f}ms, overhead {:.1f}ms {}'.format(
+                name, t * 1000, overhead * 1000, 'ok' if ok else 'SLOW (target {:.0f}ms)'.format(target * 1000)))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
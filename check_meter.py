@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Check that --stats-file is written for tar, tar.* and filters, also for inputs small enough
+to be handled in-process otherwise.
+
+usage: check_meter.py
+"""
+
+import sys, os, subprocess, tempfile, json
+
+
+def main():
+    packer = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'packer.py')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, XDG_CACHE_HOME=os.path.join(tmp, 'cache'))
+        with open(os.path.join(tmp, '1.txt'), 'w') as f:
+            f.write('hello\n' * 1000)
+        cases = [
+            ('pack tar.gz', ['1.txt', '--to', '1.tar.gz']),
+            ('unpack tar.gz', ['-x', '1.tar.gz', '--to', 'out']),
+            ('pack gz', ['1.txt', '--format', 'gz', '--to', '1.txt.gz']),
+            ('unpack gz', ['-x', '1.txt.gz', '--to', '2.txt']),
+        ]
+        failed = False
+        for i, (name, argv) in enumerate(cases):
+            stats_file = os.path.join(tmp, 'stats{}.json'.format(i))
+            ret = subprocess.call([sys.executable, packer] + argv + ['--stats-file', stats_file], cwd=tmp, env=env)
+            try:
+                with open(stats_file) as f:
+                    stats = json.load(f)
+                ok = ret == 0 and stats['retcode'] == 0 and stats['bytes_in'] > 0 and stats['bytes_out'] > 0
+            except (OSError, ValueError, KeyError):
+                ok = False
+            failed = failed or not ok
+            print('{:14} {}'.format(name, 'ok' if ok else 'FAILED, no stats'))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
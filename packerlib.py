@@ -0,0 +1,5683 @@
+# -*- coding: utf-8 -*-
+
+"""
+Introduction
+============
+
+`packer.py` is a wrapper around popular file archiving/compressing tools (tar, zip, rar, gzip, ...).
+The purpose of this script is to provide unified command-line interface to existing tools,
+so you don't need to read boring manpages when you forget the command-line option of tar, 7z, zip, and etc.
+There is a similar project `atool` that achieves the same purpose.
+
+`packer.py` currently supports 7z, rar, zip, tar, tar.*, gzip, bzip2, xz, lzma, lzip, lzop, zstd, lz4 formats.
+`packer.py` identifies archive by magic bytes and falls back to `file` command,
+then the appropriate tool was used to handle that archive.
+If the type of a archive can't be identified, 7z was used to handle that archive.
+Small tar, tar.gz, tar.bz2, tar.xz, gz, bz2, xz, lzma and zip archives are handled in-process
+with python standard library, which is faster than spawning the tools.
+
+packer.py requires python3.9+, plumbum, and packerlib.py next to it (`make install` puts both in /usr/local/bin).
+
+Usage
+=====
+```
+{usage}
+```
+
+Installation
+============
+
+Get some command-line tools that packer.py can work with.
+
+`apt-get install p7zip-full rar zip unzip tar gzip bzip2 xz-utils lzma lzip lzop zstd lz4`
+
+Install dependency
+
+`pip install plumbum`
+
+Copy packer.py to /usr/local/bin and create `packer` symlinks by executing
+
+`make install`
+
+Python API
+==========
+
+`packer.py` can be imported and used from asyncio, commands run as asyncio subprocesses
+and at most `limit` operations run at once.
+```
+import packer
+result = await packer.unpack_async('archive.tgz', to='dir/')
+listing = await packer.list_async('archive.zip')    # listing['records']
+async_packer = packer.AsyncPacker(limit=4)
+await async_packer.pack(['dir/'], to='dir.tar.zst', level=19)
+```
+
+Options
+=======
+```
+{options}
+```
+"""
+
+# TODO: --override option
+# TODO: --comment option
+# TODO: cpio, dar, ar, arj, ace, arc, rpm, deb, cab, rzip, lrzip, alzip, lha
+# TODO: atool
+# TODO: bash completion
+
+import sys, os, argparse, shlex, time
+from io import StringIO
+try:
+    import fcntl
+except ImportError:     # windows
+    fcntl = None
+
+
+def print_usage(app, file=sys.stdout):
+    s_compress = """
+    compress files
+    --------------
+    {app} 1.txt 2.txt --to archive.7z
+    {app} dir/ --format=tar.gz                  # got dir.tar.gz
+    {app} 1.txt 2.txt --format gz               # got 1.txt.gz, 2.txt.gz
+    cat file | {app} - --format xz > file.xz    # read from stdin
+    {app} dir/ --best -v                        # choose format and level by sampling
+    {app} dir/ --to dir.tar.zst --seekable      # random access and parallel extraction
+    {app} build/ --to build.zip --dedup         # store identical files once
+    """
+    s_extract = """
+    extract
+    -------
+    {app} -x archive.tgz                        # extract to current dir
+    {app} -x archive.7z --to directory/         # extract to directory/
+    {app} -x archive.gz --to -     # write contents of archive.gz to stdout
+    {app} -x a.tgz b.zip --jobs 4 --to dir/      # extract to dir/a/, dir/b/
+    {app} -x archive.tar.xz --member 'etc/*.conf'   # extract matching members only
+    curl -s URL | {app} -x - --to dir/          # extract while downloading
+    """
+    s_view = """
+    view
+    ----
+    {app} --list archive.rar                    # list archive.rar
+    {app} --test --list archive.rar             # test archive.rar
+    {app} --list archive.zip --format-output csv    # machine readable listing
+    {app} --test --list *.tar.gz *.zip --jobs 8 --format-output jsonl
+    """
+    s_convert = """
+    convert
+    -------
+    {app} --convert archive.tar.bz2 --to archive.tar.xz  # without temporary files
+    {app} --convert archive.zip --to archive.tar.gz
+    """
+    s_update = """
+    update
+    ------
+    {app} --update archive.7z dir/              # add new and changed files only
+    {app} --update archive.tar.gz dir/          # write archive.delta-N.tar.gz
+    """
+    s_benchmark = """
+    benchmark
+    ---------
+    {app} --benchmark --to result.json          # benchmark on generated corpus
+    {app} --benchmark dir/ --formats tar.gz,zip --levels 1,9
+    {app} --benchmark --compare result.json     # report regressions
+    """
+    s_serve = """
+    server
+    ------
+    {app} --serve /run/packer.sock --jobs 8     # warm process for frequent calls
+    PACKER_SOCKET=/run/packer.sock {app} -x archive.tgz
+"""
+    s = 'usage:' + s_compress + s_extract + s_view + s_convert + s_update + s_benchmark + s_serve
+    print(s.format(app=app), file=file)
+
+
+def print_options_help(app, file=sys.stdout):
+    print("""options:
+  -h, --help
+                        show this help message and exit
+  -v, --verbosity
+                        increase output verbosity
+  -x ARCHIVE [ARCHIVE ...], --extract ARCHIVE [ARCHIVE ...]
+                        extract ARCHIVE, each ARCHIVE is extracted to its own directory
+                        if multiple ARCHIVEs are given. ARCHIVE - is read from stdin as it
+                        arrives, tar.* and zip are extracted without a temporary file
+  --member GLOB, -m GLOB
+                        extract members matching GLOB only, must be used with -x.
+                        tar, tar.{gz,bz2,xz} are indexed to ARCHIVE.index.json on first access,
+                        later extractions decompress from the nearest checkpoint before the member
+  --io-jobs N
+                        max number of ARCHIVEs extracted concurrently from the same device,
+                        must be used with -x
+  --to OUTPUT
+                        output to OUTPUT (file or dir)
+  --list ARCHIVE [ARCHIVE ...], -l ARCHIVE [ARCHIVE ...]
+                        list files in ARCHIVE
+  --test, -t
+                        test ARCHIVE, must be used with --list. all data is decoded and
+                        checked, tar headers too, in-process except for 7z, rar, and tar.* or
+                        filters not handled by python. --jobs ARCHIVEs are tested concurrently
+  --format-output {json,jsonl,csv}
+                        list ARCHIVE as records of path, size, compressed_size, mtime,
+                        mode, crc and type, must be used with --list. with --test, report
+                        archive, format, status, size, decoded, seconds, mb_per_s and error
+  --convert ARCHIVE
+                        convert ARCHIVE to tar, tar.* archive given by --to,
+                        zip, 7z and rar members are streamed into the tar
+  --update ARCHIVE, -u ARCHIVE
+                        add new and changed INPUTS to ARCHIVE, files are tracked in
+                        ARCHIVE.manifest.json. compressed tar can not be updated in place,
+                        new and changed files are written to delta layer ARCHIVE.delta-N.tar.*
+  --benchmark [CORPUS]
+                        pack, extract and list CORPUS (or a generated corpus of --corpus-size MB)
+                        with each format, packer and level, record wall time, cpu time, peak rss,
+                        throughput and ratio to --to RESULT as json
+  --formats FORMATS, --levels LEVELS
+                        comma separated formats and levels to benchmark
+  --compare RESULT
+                        report regressions against a previous benchmark RESULT
+  --repeat N
+                        run each benchmark N times and keep the best
+  --tools
+                        show installed tools, their versions and features. tools are looked up
+                        once and cached in $XDG_CACHE_HOME/packer/tools.json until PATH, a directory
+                        in PATH or the tool changes, --no-cache probes them again
+  --serve SOCKET
+                        keep one process with imports and tool lookups done, and run requests
+                        of clients on unix SOCKET, each in a forked worker with the stdin, stdout,
+                        stderr, working directory and environment of the client. at most --jobs
+                        requests run at once (default to number of cpus), a request is cancelled
+                        when its client goes away
+  --client=SOCKET
+                        run the command in the server on SOCKET, PACKER_SOCKET=SOCKET in the
+                        environment does the same. without a server the command is run locally
+  --password PASSWORD, --passwd PASSWORD, -p PASSWORD
+                        specify password for archive
+  --extra-opt EXTRA_OPT
+                        extra options passed to the packer
+  --packer {lzma,bzip2,unzip,zip,tar,lzop,7zr,lzip,xz,unrar,rar,gzip,winrar,7z,zstd,lz4,builtin}
+                        specify packer, builtin packer handles tar, tar.{gz,bz2,xz}, gz, bz2, xz,
+                        lzma and zip in-process, it is used by default for files smaller than 4M
+  --format FORMAT, -f FORMAT
+                        specify archive format
+  --fast, --balanced, --best, --min-throughput SPEED
+                        choose format and level by trying codecs on a sample of INPUTS,
+                        for highest throughput, best ratio above 20MB/s, best ratio,
+                        or best ratio above SPEED (like 200MB/s). the format from --format
+                        or --to is kept, only its level is chosen then
+  --sample-time SECONDS
+                        time limit of trying codecs, default to 2
+  --seekable
+                        write tar.gz, tar.xz or tar.zst of independently compressed 4M blocks
+                        with an index of members, embedded in tar.gz and tar.zst and saved to
+                        ARCHIVE.index.json. it is extracted and listed with --threads blocks
+                        decompressed at once, and --member seeks to the blocks of the member
+  --dedup
+                        store files with the same content as an earlier file once. inputs of the
+                        same size are hashed with --threads threads. tar and tar.* store them as hard
+                        links, which share mode and mtime when extracted. zip and 7z store them with
+                        .packer-dedup.json, which -x uses to copy them back (not with --member)
+  --no-cache
+                        do not use cached archive identification
+                        (cached in $XDG_CACHE_HOME/packer/identify.json)
+  --jobs N, -j N
+                        number of files or ARCHIVEs processed concurrently, default to 1
+  --threads N, -T N
+                        number of threads used by compressor, default to number of cpus
+                        (pigz, pbzip2, lbzip2, xz -T, plzip, zstd -T are used if installed),
+                        zip larger than 16M is extracted by N processes.
+                        when extracting, pigz -d, lbzip2 -d, pbzip2 -d, xz -d -T and plzip -d
+                        are used if installed, multi-block xz (xz -T, pixz), multi-stream bz2
+                        (pbzip2), multi-member lz (plzip) and any bz2 with lbzip2 are decoded in
+                        parallel, gz gains from pigz doing crc and io in other threads, zstd
+                        decompression is single-threaded
+  --level N, -L N
+                        compression level
+  --long [WINDOW_LOG]
+                        zstd long distance matching, WINDOW_LOG defaults to 27
+  --train-dict
+                        train a zstd dictionary on INPUTS and compress each of them with it,
+                        for many small similar files. the dictionary is saved to --dict or
+                        packer.zstd-dict beside the INPUTS, and is looked up there when extracting
+  --dict FILE
+                        zstd dictionary used to compress or extract
+  --progress
+                        report bytes in and out, MB/s, ratio and ETA of tar, tar.* and filters
+                        to stderr, the data is passed between the commands through packer
+  --stats-file FILE
+                        write bytes in and out, seconds, MB/s and ratio to FILE as json
+  --timings, --timings=TRACE
+                        time argument parsing, identification, command lookups, output dir
+                        creation and each command with its cpu time and peak rss, print a summary
+                        to stderr, or write TRACE in chrome trace format (chrome://tracing, Perfetto)
+  --dry-run, --simulate
+                        do not run the command
+""", file=file)
+
+
+def print_help(app, file=sys.stdout):
+    print_usage(app, file=file)
+    print_options_help(app, file=file)
+
+
+def fill_doc_string():
+    # complete __doc__ string
+    usage = StringIO()
+    print_usage(app='packer.py', file=usage)
+    usage = usage.getvalue()
+
+    options = StringIO()
+    print_options_help(app='packer.py', file=options)
+    options = options.getvalue()
+
+    global __doc__
+    __doc__ = __doc__.format(usage=usage, options=options)
+
+
+class ParseError(Exception):
+    pass
+
+
+class CommandNotFound(Exception):
+    pass
+
+
+class LocalCommands:
+    """
+    Lazy plumbum.local, plumbum is imported when the first command is looked up.
+    Commands are resolved by tool_registry, missing ones fail without walking PATH again.
+    """
+    def __getitem__(self, name):
+        path = tool_registry.which(name)
+        if path is None:
+            raise CommandNotFound(name)
+        import plumbum
+        try:
+            return plumbum.local[path]
+        except plumbum.CommandNotFound:
+            raise CommandNotFound(name)
+
+local = LocalCommands()
+
+
+def terminal_width():
+    """
+    Columns of the terminal like shutil.get_terminal_size(), without importing shutil.
+    """
+    try:
+        return int(os.environ['COLUMNS'])
+    except (KeyError, ValueError):
+        pass
+    try:
+        return os.get_terminal_size(sys.__stdout__.fileno()).columns
+    except (AttributeError, ValueError, OSError):
+        return 80
+
+
+def make_formatter(prog):
+    # argparse makes a formatter for every argument added, with width=None it imports shutil each time
+    return argparse.RawDescriptionHelpFormatter(prog, width=terminal_width() - 2)
+
+
+class SilentArgumentParser(argparse.ArgumentParser):
+    """
+    ArgumentParser that do not exit on parsing failure.
+    """
+    def __init__(self, *args, **kwds):
+        super(SilentArgumentParser, self).__init__(formatter_class=make_formatter, *args, **kwds)
+
+    def error(self, message):
+        raise ParseError('not match')
+
+    def user_error(self, msg):
+        print(msg, file=sys.stderr)
+        self.print_usage()
+
+
+# cmds: zip, unzip, rar, unrar, 7z, 7za, 7zr, tar, ar, gzip, xz, bzip2, lzma, lzip, lzop, compress
+# uses: zip, rar, unrar, 7z, tar, gzip, xz, bzip2
+
+filter_type = {'gz', 'bz2', 'xz', 'lzma', 'Z', 'lz', 'lzo', 'zst', 'lz4'}
+tar_type = {'tar'} | {'tar.' + x for x in filter_type}
+suf2filter = {
+    'gz'  : 'gzip',
+    'bz2' : 'bzip2',
+    'xz'  : 'xz',
+    'lzma': 'lzma',
+    'Z'   : 'compress',
+    'lz'  : 'lzip',
+    'lzo' : 'lzop',
+    'zst' : 'zstd',
+    'lz4' : 'lz4',
+}
+# multi-threaded implementations of filters, preferred over suf2filter when installed.
+# (command, option to set number of threads)
+# they all produce plain single-stream compatible output.
+suf2parallel_filter = {
+    'gz'  : (('pigz', '-p{}'),),
+    'bz2' : (('pbzip2', '-p{}'), ('lbzip2', '-n{}')),
+    'xz'  : (('xz', '-T{}'),),
+    'lz'  : (('plzip', '-n{}'),),
+    'zst' : (('zstd', '-T{}'),),
+}
+# decompressors using more than one thread, (command, options), options format the number of threads.
+# lbzip2 decodes any bz2 in parallel, pbzip2 only multi-stream bz2 (written by pbzip2),
+# xz only multi-block xz (written by xz -T, pixz or --seekable), plzip only multi-member lz.
+# pigz -d inflates in one thread, but reads, writes and checks crc in others.
+# zstd decompression is single-threaded.
+# the third item is the feature required in tool_registry.
+suf2parallel_decompressor = {
+    'gz'  : (('pigz', ['-d', '-p{}'], None),),
+    'bz2' : (('lbzip2', ['-d', '-n{}'], None), ('pbzip2', ['-d', '-p{}'], None)),
+    'xz'  : (('xz', ['-d', '-T{}'], 'parallel_decode'),),
+    'lz'  : (('plzip', ['-d', '-n{}'], None),),
+}
+zstd_dict_name = 'packer.zstd-dict'     # dictionary trained by --train-dict, looked up beside .zst files
+
+
+def get_compressor(suf, threads=1):
+    if threads is not None and threads > 1:
+        for cmd_bin, opt in suf2parallel_filter.get(suf, ()):
+            try:
+                return local[cmd_bin][opt.format(threads)]
+            except CommandNotFound:
+                continue
+    return local[suf2filter[suf]]
+
+
+def get_parallel_decompressor(suf, threads):
+    if threads is not None and threads > 1:
+        for cmd_bin, opt, feature in suf2parallel_decompressor.get(suf, ()):
+            if feature is not None and not tool_registry.has(cmd_bin, feature):
+                continue
+            try:
+                return local[cmd_bin][[x.format(threads) for x in opt]]
+            except CommandNotFound:
+                continue
+    return None
+
+
+def get_decompressor(suf, threads=1):
+    decompressor = get_parallel_decompressor(suf, threads)
+    if decompressor is not None:
+        return decompressor
+    if suf == 'Z':
+        return local['gzip']['-d']
+    elif suf == 'zst':
+        # allow windows larger than the default limit (--long)
+        return local['zstd']['-d', '--long=31']
+    return local[suf2filter[suf]]['-d']
+
+
+def compressor_options(suf, args):
+    opt = []
+    if args.level is not None:
+        if suf == 'Z':
+            raise Exception('compress has no compression levels, --level is not supported for Z')
+        if suf == 'zst' and args.level > 19:
+            opt.append('--ultra')
+        opt.append('-{}'.format(args.level))
+    if suf == 'zst' and args.long is not None:
+        opt.append('--long={}'.format(args.long))
+    return opt
+
+
+def get_format_by_filename(filename):
+    if '.' not in filename:
+        return None
+    ext = filename.split('.')[-2:]
+    if len(ext) == 2:
+        if ext[0].lower() == 'tar':
+            return format_normalize('.'.join(ext))
+    return format_normalize(ext[-1])
+
+
+def format_normalize(fmt):
+    if fmt in {'taZ', 'tar.Z'}:
+        return 'tar.Z'
+    if fmt.upper() == 'Z':
+        return 'Z'
+
+    lfmt = fmt.lower()
+    norm = {
+        'tgz'  : 'tar.gz',
+        'taz'  : 'tar.gz',
+        'tz2'  : 'tar.bz2',
+        'tbz'  : 'tar.bz2',
+        'tbz2' : 'tar.bz2',
+        'tlz'  : 'tar.lzma',
+        'tzst' : 'tar.zst',
+        'tar.zstd': 'tar.zst',
+        'tlz4' : 'tar.lz4',
+        'zstd' : 'zst',
+        'gzip' : 'gz',
+        'bzip2': 'bz2',
+        'lzip' : 'lz',
+        'lzop' : 'lzo',
+    }
+    if lfmt in norm:
+        return norm[lfmt]
+    else:
+        return lfmt
+
+
+def run_cmd(cmd, verbose=False):
+    if verbose:
+        print('running: ' + str(cmd), file=sys.stderr)
+    from plumbum import FG, ProcessExecutionError
+    try:
+        cmd & FG
+        return 0
+    except ProcessExecutionError as e:
+        return e.retcode
+
+
+def run_cmd_dry(cmd, verbose=False):
+    print(str(cmd))
+    return 0
+
+
+## begin pack*
+def pack_tar(args):
+    tar = local['tar']
+
+    tar_opt = ['cf', '-']
+    if args.extra_opt is not None:
+        tar_opt += shlex.split(args.extra_opt)
+    if args.verbosity:
+        tar_opt.append('-v')
+    tar_opt.append('--')
+    tar_opt += args.inputs
+
+    cmds = [tar[tar_opt]]
+    if args.format != 'tar':
+        _, suf = args.format.split('.')
+        compressor = get_compressor(suf, args.threads)
+        compressor_opt = compressor_options(suf, args)
+        if args.verbosity:
+            compressor_opt.append('-v')
+        cmds.append(compressor[compressor_opt])
+
+    if args.progress or args.stats_file is not None:
+        return run_metered(cmds, None, args.archive, get_inputs_size(args.inputs), args, True)
+    if len(cmds) == 1:
+        cmd = cmds[0] > args.archive
+    else:
+        cmd = (cmds[0] | cmds[1]) > args.archive
+    return run_cmd(cmd, args.verbosity)
+
+
+def pack_filter(args):
+    opt = compressor_options(args.format, args)
+    if args.verbosity:
+        opt.append('-v')
+    if args.extra_opt is not None:
+        opt += shlex.split(args.extra_opt)
+    if args.train_dict and args.format == 'zst':
+        inputs = [x for x in args.inputs if x != '-']
+        if not inputs:
+            raise Exception('--train-dict needs files to train on, not stdin')
+        dict_file = args.dict or os.path.join(os.path.dirname(inputs[0]), zstd_dict_name)
+        ret = run_cmd(local['zstd'][['--train', '-o', dict_file, '--'] + inputs], args.verbosity)
+        if ret != 0:
+            return ret
+        opt += ['-D', dict_file]
+    elif args.dict is not None:
+        opt += ['-D', args.dict]
+
+    meter = metered(args, args.format)
+    # progress of concurrent compressors would be interleaved
+    jobs = 1 if meter else max(1, min(args.jobs, len(args.inputs)))
+    if args.packer is None:
+        # share cpus between concurrent compressors
+        compressor = get_compressor(args.format, max(1, args.threads // jobs))
+    else:
+        compressor = local[args.packer]
+
+    def compress(x):
+        outfile = filter_output_name(args, x)
+        cmd = compressor[opt]
+        if meter:
+            total = get_file_size(x) if x != '-' else None
+            try:
+                return run_metered([cmd], x, outfile, total, args, True)
+            except OSError as e:
+                print('{}: {}'.format(x, e.strerror), file=sys.stderr)
+                return 1
+        if x != '-':
+            cmd = cmd < x
+        if outfile != '-':
+            cmd = cmd > outfile
+        try:
+            return run_cmd(cmd, args.verbosity)
+        except OSError as e:
+            print('{}: {}'.format(x, e.strerror), file=sys.stderr)
+            return 1
+
+    if jobs == 1:
+        retcodes = [compress(x) for x in args.inputs]
+    else:
+        # start large files first, so the slowest job does not start last
+        from concurrent.futures import ThreadPoolExecutor
+        order = sorted(range(len(args.inputs)), key=lambda i: -get_file_size(args.inputs[i]))
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = {i: executor.submit(compress, args.inputs[i]) for i in order}
+            retcodes = [futures[i].result() for i in range(len(args.inputs))]
+
+    return report_failures(args.inputs, retcodes)
+
+
+def filter_output_name(args, x):
+    if len(args.inputs) == 1:
+        return args.archive
+    else:   # multiple inputs
+        if x == '-':
+            return '-'
+        else:
+            return x + '.' + args.format
+
+
+def get_file_size(filename):
+    try:
+        return os.path.getsize(filename)
+    except OSError:     # stdin or missing file
+        return 0
+
+
+def report_failures(names, retcodes):
+    failed = [(x, r) for x, r in zip(names, retcodes) if r != 0]
+    if len(names) > 1:
+        for x, r in failed:
+            print('failed: {} (exit code {})'.format(x, r), file=sys.stderr)
+        if failed:
+            print('{} of {} failed'.format(len(failed), len(names)), file=sys.stderr)
+    return max((r for _, r in failed), default=0)
+
+
+def pack_7z_common(args, cmd_bin):
+    sevenz = local[cmd_bin]
+    opt = ['a', args.archive, '-t' + format_normalize(args.format)]
+    if args.level is not None:
+        opt.append('-mx={}'.format(args.level))
+    if args.password is not None:
+        opt.append('-p' + args.password)
+    if args.extra_opt is not None:
+        opt += shlex.split(args.extra_opt)
+    duplicates = getattr(args, 'duplicates', None)
+    if duplicates:
+        return pack_7z_dedup(args, sevenz, opt, duplicates)
+    opt.append('--')
+    opt += args.inputs
+
+    cmd = sevenz[opt]
+    return run_cmd(cmd, args.verbosity)
+
+
+def pack_7z_dedup(args, sevenz, opt, duplicates):
+    """
+    Exclude the duplicates by name, without wildcards, then add the manifest to restore them.
+    """
+    import tempfile
+    with tempfile.TemporaryDirectory(prefix='packer-') as tmp:
+        exclude = os.path.join(tmp, 'exclude')
+        with open(exclude, 'w', errors='surrogateescape') as f:
+            for path in duplicates:
+                f.write(dedup_arcname(path) + '\n')
+        ret = run_cmd(sevenz[opt + ['-spd', '-x@' + exclude, '--'] + args.inputs], args.verbosity)
+        if ret != 0:
+            return ret
+        manifest = write_dedup_manifest(tmp, duplicates)
+        return run_cmd(sevenz[[x for x in opt if not x.startswith('-mx=')] + ['--', manifest]], args.verbosity)
+
+
+def pack_7z(args):
+    return pack_7z_common(args, '7z')
+
+
+def pack_7zr(args):
+    return pack_7z_common(args, '7zr')
+
+
+def pack_rar(args):
+    rar = local['rar']
+    opt = ['a', args.archive]
+    opt.append('-r')    # rar is not recursive by default
+    if args.level is not None:
+        opt.append('-m{}'.format(args.level))
+    if args.password is not None:
+        opt.append('-p' + args.password)
+    if args.extra_opt is not None:
+        opt += shlex.split(args.extra_opt)
+    opt.append('--')
+    opt += args.inputs
+
+    cmd = rar[opt]
+    return run_cmd(cmd, args.verbosity)
+
+
+def pack_winrar(args):
+    rar = local['winrar']
+    opt = ['a', args.archive, '-af' + args.format]
+    opt.append('-r')    # rar is not recursive by default
+    if args.level is not None:
+        opt.append('-m{}'.format(args.level))
+    if args.password is not None:
+        opt.append('-p' + args.password)
+    if args.extra_opt is not None:
+        opt += shlex.split(args.extra_opt)
+    opt.append('--')
+    opt += args.inputs
+
+    cmd = rar[opt]
+    return run_cmd(cmd, args.verbosity)
+
+
+def pack_zip(args):
+    zip_cmd = local['zip']
+    opt = ['-r', args.archive]
+    if args.level is not None:
+        opt.append('-{}'.format(args.level))
+    if args.extra_opt is not None:
+        opt += shlex.split(args.extra_opt)
+    if args.password is not None:
+        opt.append('-P' + args.password)
+    if args.verbosity:
+        opt.append('-v')
+    duplicates = getattr(args, 'duplicates', None)
+    if duplicates:
+        return pack_zip_dedup(args, zip_cmd, opt[1:], duplicates)
+    opt.append('--')
+    opt += args.inputs
+
+    cmd = zip_cmd[opt]
+    return run_cmd(cmd, args.verbosity)
+
+
+def pack_zip_dedup(args, zip_cmd, opt, duplicates):
+    """
+    zip the files that are not duplicates, names are listed on stdin since zip -x does not match all of them,
+    then add the manifest to restore the duplicates.
+    """
+    import tempfile
+    with tempfile.TemporaryDirectory(prefix='packer-') as tmp:
+        names = os.path.join(tmp, 'names')
+        with open(names, 'w', errors='surrogateescape') as f:
+            for x in args.inputs:
+                for path in iter_input_tree(x, follow=True):
+                    if path not in duplicates:
+                        f.write(path + '\n')
+        ret = run_cmd(zip_cmd[opt + ['-nw', '-@']] < names, args.verbosity)
+        if ret != 0:
+            return ret
+        manifest = write_dedup_manifest(tmp, duplicates)
+        return run_cmd(zip_cmd[[args.archive, '-j', '--', manifest]], args.verbosity)
+
+
+format2packer = {
+    '7z'     : (pack_7z, pack_7zr),
+    'rar'    : (pack_rar, pack_winrar),
+    'zip'    : (pack_zip, pack_7z, pack_winrar),
+    'unknown': (pack_7z, pack_winrar),
+}
+
+
+def pack(args):
+    fmt = args.format = format_normalize(args.format)
+    if getattr(args, 'seekable', False):
+        if fmt not in seekable_type:
+            raise Exception('--seekable supports ' + ', '.join(sorted(seekable_type)))
+        return pack_seekable(args)
+    if getattr(args, 'dedup', False):
+        if fmt not in tar_type | {'zip', '7z'}:
+            raise Exception('--dedup supports tar, tar.*, zip and 7z')
+        # hard links of tar share mode, owner and mtime, the manifest of zip and 7z restores them per file
+        args.duplicates = find_duplicates(args.inputs, args.threads, same_metadata=fmt in tar_type)
+        if fmt in tar_type:
+            return pack_tar_dedup(args)
+    if not metered(args, fmt) and use_builtin(args, fmt, builtin_tar_type | builtin_filter_type | {'zip'},
+                                              lambda: get_inputs_size(args.inputs, builtin_threshold)):
+        if fmt != 'zip' or not os.path.exists(args.archive):    # zip -r updates existing archive
+            return pack_builtin(args)
+    if args.packer == 'builtin':
+        args.packer = None
+    # tar, tar.*
+    if fmt in tar_type:
+        return pack_tar(args)
+    # filter_type = {'gz', 'bz2', 'xz', 'lzma', 'Z', 'lz', 'lzo', 'zst', 'lz4'}
+    elif fmt in filter_type:
+        return pack_filter(args)
+    elif fmt in {'7z', 'rar', 'zip'}:
+        if args.packer is None:
+            for packer in format2packer[fmt]:
+                try:
+                    return packer(args)
+                except CommandNotFound:
+                    continue
+            else:
+                raise Exception(str(format2packer[fmt]) + ' not found')
+        else:
+            packer = getattr(sys.modules[__name__], 'pack_' + args.packer)
+            return packer(args)
+    else:
+        raise Exception('unhandled format')
+## end pack*
+
+
+## begin dedup*
+dedup_manifest = '.packer-dedup.json'
+
+
+def iter_input_tree(path, follow=False, ancestors=frozenset()):
+    """
+    path and everything under it in the order tarfile adds them, sorted and each directory before its contents.
+    With follow, symlinks to directories are walked like zip does, but not into a directory of their own path.
+    """
+    import stat
+    try:
+        st = os.stat(path) if follow else os.lstat(path)
+    except OSError:
+        yield path
+        return
+    if follow and stat.S_ISDIR(st.st_mode):
+        key = (st.st_dev, st.st_ino)
+        if key in ancestors:
+            return
+        ancestors = ancestors | {key}
+    yield path
+    if stat.S_ISDIR(st.st_mode):
+        for name in sorted(os.listdir(path)):
+            yield from iter_input_tree(os.path.join(path, name), follow, ancestors)
+
+
+def find_duplicates(inputs, threads, same_metadata=False):
+    """
+    Map each regular file under inputs to an earlier file with the same content.
+    Files are bucketed by size first, only files sharing their size with another one are hashed.
+    With same_metadata, duplicates also have the same mode, owner and mtime, as hard links share them.
+    """
+    import stat
+    from concurrent.futures import ThreadPoolExecutor
+    by_size = {}
+    metadata = {}
+    for x in inputs:
+        if x == '-':
+            continue
+        for path in iter_input_tree(x):
+            try:
+                st = os.lstat(path)
+            except OSError:
+                continue
+            if stat.S_ISREG(st.st_mode) and st.st_size > 0 and path not in metadata:
+                metadata[path] = (st.st_mode, st.st_uid, st.st_gid, st.st_mtime_ns) if same_metadata else None
+                by_size.setdefault(st.st_size, []).append(path)
+
+    candidates = [x for paths in by_size.values() if len(paths) > 1 for x in paths]
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+        digests = dict(zip(candidates, executor.map(hash_file, candidates)))
+    duplicates = {}
+    for paths in by_size.values():
+        if len(paths) < 2:
+            continue
+        first = {}
+        for path in paths:
+            key = (digests[path], metadata[path])
+            if key in first:
+                duplicates[path] = first[key]
+            else:
+                first[key] = path
+    return duplicates
+
+
+def tar_arcname(path):
+    """
+    Name of path in tar written by tarfile.
+    """
+    return os.path.splitdrive(path)[1].replace(os.sep, '/').lstrip('/')
+
+
+def dedup_arcname(path):
+    """
+    Name of path in zip and 7z.
+    """
+    return os.path.normpath(os.path.splitdrive(path)[1]).replace(os.sep, '/').lstrip('/')
+
+
+def dedup_manifest_data(duplicates):
+    import json, stat
+    files = []
+    for path, source in duplicates.items():
+        st = os.stat(path)
+        files.append({'path': dedup_arcname(path), 'source': dedup_arcname(source),
+                      'mode': stat.S_IMODE(st.st_mode), 'mtime': st.st_mtime})
+    return json.dumps({'generator': 'packer', 'version': 1, 'files': files}, indent=1).encode()
+
+
+def write_dedup_manifest(directory, duplicates):
+    path = os.path.join(directory, dedup_manifest)
+    with open(path, 'wb') as f:
+        f.write(dedup_manifest_data(duplicates))
+    return path
+
+
+def pack_tar_dedup(args):
+    """
+    tar written by tarfile, files with the content of an earlier file are stored as hard links to it.
+    """
+    import tarfile, subprocess
+    links = {tar_arcname(x): tar_arcname(y) for x, y in args.duplicates.items()}
+
+    def dedup(tarinfo):
+        if tarinfo.isreg() and tarinfo.name in links:
+            tarinfo.type = tarfile.LNKTYPE
+            tarinfo.linkname = links[tarinfo.name]
+            tarinfo.size = 0
+        if args.verbosity:
+            print(tarinfo.name, file=sys.stderr)
+        return tarinfo
+
+    def pack_tar_dedup_builtin():
+        proc = None
+        if args.format == 'tar':
+            dst = open_plain(args.archive, 'wb')
+        else:
+            suf = args.format.split('.')[1]
+            compressor = get_compressor(suf, args.threads)[compressor_options(suf, args)]
+            with open_plain(args.archive, 'wb') as out:
+                proc = compressor.popen(stdin=subprocess.PIPE, stdout=out, stderr=None)
+            dst = proc.stdin
+        try:
+            with tarfile.open(fileobj=dst, mode='w|') as tar:
+                for x in args.inputs:
+                    tar.add(x, filter=dedup)
+        finally:
+            dst.close()
+            if proc is not None:
+                proc.wait()
+        if proc is not None and proc.returncode != 0:
+            raise Exception('{} exited with {}'.format(compressor, proc.returncode))
+
+    return run_builtin('tar --dedup ' + args.format, pack_tar_dedup_builtin, args.verbosity)
+
+
+def dedup_manifest_path(args):
+    return os.path.join(args.output if args.output is not None else '.', dedup_manifest)
+
+
+def restore_dedup(args):
+    """
+    Restore the duplicates left out of a zip or 7z archive packed with --dedup.
+    """
+    path = dedup_manifest_path(args)
+    if format_normalize(args.format or 'unknown') not in {'zip', '7z'} \
+            or os.path.islink(path) or not os.path.isfile(path):
+        return 0
+    directory = os.path.dirname(path)
+    return run_builtin('restore ' + dedup_manifest, lambda: apply_dedup_manifest(directory), args.verbosity)
+
+
+def apply_dedup_manifest(directory):
+    """
+    Copy the files stored once to the paths of their duplicates, keeping the timestamps of the directories.
+    Manifests not written by packer are left alone, paths must stay in directory and symlinks are not followed.
+    """
+    import json
+    manifest = os.path.join(directory, dedup_manifest)
+    with open(manifest) as f:
+        data = json.load(f)
+    if not isinstance(data, dict) or data.get('generator') != 'packer':
+        return
+    root = os.path.realpath(directory)
+    nofollow = getattr(os, 'O_NOFOLLOW', 0)
+
+    def target(name):
+        path = os.path.normpath(name)
+        if os.path.isabs(path) or path == os.pardir or path.startswith(os.pardir + os.sep):
+            raise Exception('unsafe path {} in {}'.format(name, manifest))
+        path = os.path.join(directory, path)
+        if os.path.commonpath([root, os.path.realpath(path)]) != root:
+            raise Exception('unsafe path {} in {}'.format(name, manifest))
+        return path
+
+    dirs = {}
+    for entry in data['files']:
+        path, source = target(entry['path']), target(entry['source'])
+        parent = os.path.dirname(path)
+        if parent not in dirs and os.path.isdir(parent):
+            st = os.stat(parent)
+            dirs[parent] = (st.st_atime_ns, st.st_mtime_ns)
+        os.makedirs(parent or '.', exist_ok=True)
+        src_fd = os.open(source, os.O_RDONLY | nofollow)
+        with open(src_fd, 'rb') as src:
+            dst_fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | nofollow, 0o600)
+            with open(dst_fd, 'wb') as dst:
+                copy_stream(src, dst)
+                dst.flush()
+                os.chmod(dst.fileno(), int(entry['mode']) & 0o7777)
+                os.utime(dst.fileno(), (entry['mtime'], entry['mtime']))
+    os.remove(manifest)
+    for parent, times in dirs.items():
+        os.utime(parent, ns=times)
+## end dedup*
+
+
+# magic bytes at the beginning of compressed streams
+magic2filter = (
+    (b'\x1f\x8b', 'gz'),
+    (b'BZh', 'bz2'),
+    (b'\xfd7zXZ\x00', 'xz'),
+    (b'\x1f\x9d', 'Z'),
+    (b'LZIP', 'lz'),
+    (b'\x89LZO\x00\r\n\x1a\n', 'lzo'),
+    (b'\x28\xb5\x2f\xfd', 'zst'),
+    (b'\x04\x22\x4d\x18', 'lz4'),
+    (b'\x5d\x00\x00', 'lzma'),   # lzma_alone has no magic, this is the header of the default lc/lp/pb
+)
+# magic bytes at the beginning of archives
+magic2archive = (
+    (b'Rar!\x1a\x07', 'rar'),
+    (b'PK\x03\x04', 'zip'),
+    (b'PK\x05\x06', 'zip'),    # empty zip
+    (b'PK\x07\x08', 'zip'),    # spanned zip
+    (b'7z\xbc\xaf\x27\x1c', '7z'),
+)
+sniff_size = 64 * 1024          # bytes read to identify a file
+sniff_size_max = 1024 * 1024    # bytes read to find the first decompressed block
+
+
+def is_tar_header(block):
+    return block[257:262] == b'ustar'
+
+
+def peek_decompress(suf, head, f):
+    """
+    Decompress the first block of a stream which begins with head and continues in f.
+    Return at least 512 bytes of decompressed data if possible.
+    """
+    if suf in {'gz', 'bz2', 'xz', 'lzma', 'lz'}:
+        if suf == 'gz':
+            import zlib
+            d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif suf == 'bz2':
+            import bz2
+            d = bz2.BZ2Decompressor()
+        elif suf == 'lz':
+            import lzma
+            # lzip is a raw lzma stream with fixed lc/lp/pb after a 6 byte header
+            if len(head) < 6:
+                return b''
+            dict_size = 1 << (head[5] & 0x1f)
+            dict_size -= (dict_size // 16) * ((head[5] >> 5) & 7)
+            filters = [{'id': lzma.FILTER_LZMA1, 'dict_size': dict_size, 'lc': 3, 'lp': 0, 'pb': 2}]
+            d = lzma.LZMADecompressor(lzma.FORMAT_RAW, filters=filters)
+            head = head[6:]
+        else:
+            import lzma
+            d = lzma.LZMADecompressor(lzma.FORMAT_XZ if suf == 'xz' else lzma.FORMAT_ALONE)
+
+        data = b''
+        total = len(head)
+        chunk = head
+        while chunk:
+            data += d.decompress(chunk, 512 - len(data))
+            if len(data) >= 512 or d.eof or total >= sniff_size_max:
+                break
+            chunk = f.read(sniff_size)
+            total += len(chunk)
+        return data
+    else:
+        # no decompressor in python, feed a bounded head to the external tool
+        limit = sniff_size_max
+        if suf == 'lz4':
+            limit += 4 * 1024 * 1024    # lz4 outputs nothing until a whole block (up to 4M) is read
+        head += f.read(limit - len(head))
+        proc = get_decompressor(suf)['-c'].popen()
+        out, _ = proc.communicate(head)
+        return out[:512]
+
+
+def sniff(f):
+    """
+    Identify format by magic bytes read from binary file object f.
+    Return None if the format is not recognized.
+    """
+    head = f.read(sniff_size)
+    for magic, suf in magic2filter:
+        if head.startswith(magic):
+            break
+    else:
+        for magic, fmt in magic2archive:
+            if head.startswith(magic):
+                return fmt
+        if is_tar_header(head):
+            return 'tar'
+        return None
+
+    try:
+        data = peek_decompress(suf, head, f)
+    except CommandNotFound:
+        return suf
+    except Exception:
+        if suf == 'lzma':   # weak magic
+            return None
+        return suf
+    if is_tar_header(data):
+        return 'tar.' + suf
+    return suf
+
+
+def get_cache_dir():
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'packer')
+
+
+class IdentifyCache:
+    """
+    On-disk LRU cache of identify() results keyed by (device, inode, size, mtime_ns).
+    Writers take an exclusive lock and replace the file atomically, so readers do not need locking.
+    """
+    max_entries = 4096
+    touch_interval = 3600   # seconds, avoid rewriting the cache on every hit
+
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(get_cache_dir(), 'identify.json')
+        self.path = path
+
+    @staticmethod
+    def key(filename):
+        st = os.stat(filename)
+        return '{}:{}:{}:{}'.format(st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def load(self):
+        import json
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return entries if isinstance(entries, dict) else {}
+
+    def get(self, filename):
+        key = self.key(filename)
+        entry = self.load().get(key)
+        if entry is None:
+            return None
+        fmt, last_used = entry
+        now = int(time.time())
+        if now - last_used > self.touch_interval:
+            self.update(key, fmt, now)
+        return fmt
+
+    def put(self, filename, fmt):
+        self.update(self.key(filename), fmt, int(time.time()))
+
+    def update(self, key, fmt, last_used):
+        import json, tempfile
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path + '.lock', 'w') as lock:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+                entries = self.load()
+                entries[key] = [fmt, last_used]
+                if len(entries) > self.max_entries:
+                    lru = sorted(entries, key=lambda k: entries[k][1])
+                    for k in lru[:len(entries) - self.max_entries]:
+                        del entries[k]
+                fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix='.identify.')
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(entries, f)
+                os.replace(tmp, self.path)
+        except OSError:
+            pass    # cache is optional
+
+
+def identify(filename, cache=True):
+    # stdin is identified by identify_stdin()
+    if cache:
+        try:
+            fmt = IdentifyCache().get(filename)
+        except OSError:
+            fmt = None
+        if fmt is not None:
+            return fmt
+
+    with open(filename, 'rb') as f:
+        fmt = sniff(f)
+    if fmt is None:
+        # self-extracting archives, old tar, etc
+        fmt = identify_by_file(filename)
+
+    if cache:
+        IdentifyCache().put(filename, fmt)
+    return fmt
+
+
+def identify_by_file(filename):
+    # BUG: tar.lzo, tar.lzma
+    file_cmd = local['file']
+    opt = ['-zb', '--', filename]
+    cmd = file_cmd[opt]
+    result = cmd()
+
+    outer = {
+        'gzip compressed data' : 'gz',
+        'bzip2 compressed data': 'bz2',
+        'XZ compressed data'   : 'xz',
+        'compress\'d data'     : 'Z',
+        'lzip compressed data' : 'lz',
+        'Zstandard compressed data': 'zst',
+        'LZ4 compressed data'  : 'lz4',
+        #'LZMA compressed data' : 'lzma',
+        #'lzop compressed data' : 'lzo',
+    }
+    for x in outer:
+        if x in result:
+            if 'tar archive' in result:
+                return 'tar.' + outer[x]
+            else:
+                return outer[x]
+    else:
+        if 'LZMA compressed data' in result:
+            try:
+                lzma = local['lzma']
+            except CommandNotFound:
+                return 'lzma'
+            else:
+                cmd = (lzma['-d'] < filename) | file_cmd['-']
+                res2 = cmd()
+                if 'tar archive' in res2:
+                    return 'tar.lzma'
+                else:
+                    return 'lzma'
+        elif 'lzop compressed data' in result:
+            try:
+                lzop = local['lzop']
+            except CommandNotFound:
+                return 'lzo'
+            else:
+                cmd = (lzop['-d'] < filename) | file_cmd['-']
+                res2 = cmd()
+                if 'tar archive' in res2:
+                    return 'tar.lzo'
+                else:
+                    return 'lzo'
+
+        sig = {
+            'RAR archive data'    : 'rar',
+            'RAR self-extracting' : 'rar',
+            'Zip archive data'    : 'zip',
+            'ZIP self-extracting' : 'zip',
+            'tar archive'         : 'tar',
+            '7-zip archive data'  : '7z',
+        }
+        for x in sig:
+            if x in result:
+                return sig[x]
+        else:
+            return 'unknown'
+
+
+## begin unpack*
+def ensure_output_dir(directory):
+    if directory is None:
+        directory = '.'
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+def ensure_output_dir_dry(directory):
+    return directory
+
+
+def unpack_tar(args):
+    args.output = ensure_output_dir(args.output)
+    tar_opt = ['xf', args.archive, '-C', args.output]
+    if args.extra_opt is not None:
+        tar_opt += shlex.split(args.extra_opt)
+    if args.verbosity:
+        tar_opt.append('-v')
+    if args.member:
+        tar_opt += ['--wildcards'] + args.member
+
+    if args.progress or args.stats_file is not None:
+        tar_opt[1] = '-'
+        cmds = [local['tar'][tar_opt]]
+        if args.format != 'tar':
+            cmds.insert(0, get_decompressor(args.format.split('.')[1], args.threads))
+        total = get_file_size(args.archive) if args.archive != '-' else None
+        return run_metered(cmds, args.archive, None, total, args, False, stdin_head(args))
+    # tar bug
+    if args.format == 'tar.lzma' and args.archive != '-':
+        tar_opt.append('--lzma')
+    cmd = tar_with_decompressor(args, tar_opt)
+    if getattr(args, 'stdin_reader', None) is not None:
+        return run_replay(cmd, args.stdin_reader, args.verbosity)
+    return run_cmd(cmd, args.verbosity)
+
+
+def tar_with_decompressor(args, tar_opt):
+    """
+    tar does not detect all formats nor compressed stdin, and runs single-threaded decompressors,
+    pipe archive through the decompressor for these, or if a parallel one is installed.
+    """
+    tar = local['tar']
+    suf = args.format.partition('.')[2] if args.format in tar_type else ''
+    decompressor = get_parallel_decompressor(suf, args.threads)
+    if decompressor is None and suf and (suf in {'zst', 'lz4'} or args.archive == '-'):
+        decompressor = get_decompressor(suf)
+    if decompressor is not None:
+        if args.archive != '-':
+            decompressor = decompressor < args.archive
+        tar_opt[1] = '-'
+        return decompressor | tar[tar_opt]
+    return tar[tar_opt]
+
+
+def zstd_dict_options(args):
+    dict_file = args.dict
+    if dict_file is None and args.archive != '-':
+        dict_file = os.path.join(os.path.dirname(args.archive), zstd_dict_name)
+        if not os.path.exists(dict_file):
+            dict_file = None
+    return ['-D', dict_file] if dict_file is not None else []
+
+
+def unpack_filter(args):
+    if args.packer is None:
+        filter_cmd = get_decompressor(args.format, args.threads)
+    else:
+        filter_cmd = local[args.packer]['-d']
+    opt = []
+    if args.packer == 'zstd':
+        opt.append('--long=31')
+    if args.format == 'zst' and args.packer in {None, 'zstd'}:
+        opt += zstd_dict_options(args)
+    if args.extra_opt is not None:
+        opt += shlex.split(args.extra_opt)
+
+    cmd = filter_cmd[opt]
+    if args.progress or args.stats_file is not None:
+        total = get_file_size(args.archive) if args.archive != '-' else None
+        return run_metered([cmd], args.archive, args.output, total, args, False, stdin_head(args))
+    if args.archive != '-':
+        cmd = cmd < args.archive
+    if args.output != '-':
+        cmd = cmd > args.output
+    if getattr(args, 'stdin_reader', None) is not None:
+        return run_replay(cmd, args.stdin_reader, args.verbosity)
+    return run_cmd(cmd, args.verbosity)
+
+
+def unpack_7z_rar_common(args, cmd_bin, rar):
+    sevenz = local[cmd_bin]
+    opt = ['x', args.archive] + (args.member or [])
+    if args.format is not None and not rar:
+        opt.append('-t' + format_normalize(args.format))
+    if args.password is not None:
+        opt.append('-p' + args.password)
+    if args.extra_opt is not None:
+        opt += shlex.split(args.extra_opt)
+    if args.output is not None:
+        args.output = ensure_output_dir(args.output)
+        if rar:
+            opt.append(args.output)
+        else:
+            opt.append('-o' + args.output)
+
+    cmd = sevenz[opt]
+    return run_cmd(cmd, args.verbosity)
+
+
+def unpack_7z(args):
+    return unpack_7z_rar_common(args, '7z', False)
+
+
+def unpack_7zr(args):
+    return unpack_7z_rar_common(args, '7zr', False)
+
+
+def unpack_rar(args):
+    return unpack_7z_rar_common(args, 'rar', True)
+
+
+def unpack_unrar(args):
+    return unpack_7z_rar_common(args, 'unrar', True)
+
+
+def unpack_winrar(args):
+    return unpack_7z_rar_common(args, 'winrar', True)
+
+
+def unpack_unzip(args):
+    unzip_cmd = local['unzip']
+    args.output = ensure_output_dir(args.output)
+    opt = ['-d', args.output]
+    if args.extra_opt is not None:
+        opt += shlex.split(args.extra_opt)
+    if args.password is not None:
+        opt.append('-P' + args.password)
+    opt += ['--', args.archive] + (args.member or [])
+
+    cmd = unzip_cmd[opt]
+    return run_cmd(cmd, args.verbosity)
+
+
+format2unpacker = {
+    '7z' : (unpack_7z, unpack_7zr, unpack_winrar),
+    'rar': (unpack_unrar, unpack_rar, unpack_winrar, unpack_7z),
+    'zip': (unpack_unzip, unpack_7z, unpack_winrar),
+}
+
+
+def unpack(args):
+    # a manifest that was there before is not from this archive
+    stale_manifest = args.output != '-' and os.path.lexists(dedup_manifest_path(args))
+    ret = unpack_archive(args)
+    if ret == 0 and args.output != '-' and not stale_manifest:
+        ret = restore_dedup(args)
+    if ret == 0 and args.output != '-':
+        layers = delta_layers(args.archive, format_normalize(args.format or 'unknown'))
+        if layers:
+            ret = unpack_layers(args, layers)
+    return ret
+
+
+def unpack_archive(args):
+    if args.archive == '-' and args.packer in {None, 'builtin'}:
+        return unpack_stdin(args)
+    fmt = args.format
+    if fmt is None:
+        fmt = identify(args.archive, cache=not args.no_cache)
+        if fmt != 'unknown':
+            args.format = fmt
+
+    fmt = format_normalize(fmt)
+    if fmt in filter_type and args.output is None and args.packer in {None, 'builtin'}:
+        if args.archive.endswith('.' + fmt):
+            args.output = args.archive[:-len('.' + fmt)]
+        else:
+            raise Exception('you must specify --to option')
+
+    if args.member:
+        if fmt in filter_type:
+            raise Exception("'%s' has no members" % fmt)
+        if args.packer in {None, 'builtin'} and (fmt in index_type | {'zip'} or seekable_index(args, fmt)):
+            return unpack_members(args, fmt)
+    index = seekable_index(args, fmt) if args.threads > 1 else None
+    if index is not None:
+        return unpack_seekable(args, index)
+    if fmt == 'zip' and args.packer in {None, 'builtin'} and args.threads > 1 \
+            and get_file_size(args.archive) >= zip_parallel_threshold:
+        return unpack_zip_parallel(args)
+    if not metered(args, fmt) and use_builtin(args, fmt, builtin_tar_type | builtin_filter_type | {'zip'},
+                                              lambda: get_file_size(args.archive)):
+        return unpack_builtin(args)
+    if args.packer == 'builtin':
+        args.packer = None
+
+    if args.packer is None:
+        # tar, tar.*
+        if fmt in tar_type:
+            return unpack_tar(args)
+        # filter_type = {'gz', 'bz2', 'xz', 'lzma', 'Z', 'lz', 'lzo', 'zst', 'lz4'}
+        elif fmt in filter_type:
+            return unpack_filter(args)
+        elif fmt in {'7z', 'rar', 'zip'}:
+            for unpacker in format2unpacker[fmt]:
+                try:
+                    return unpacker(args)
+                except CommandNotFound:
+                    continue
+            else:
+                raise Exception(str(format2unpacker[fmt]) + ' not found')
+        elif fmt == 'unknown':
+            for unpacker in (unpack_7z, unpack_rar, unpack_winrar):
+                try:
+                    return unpacker(args)
+                except CommandNotFound:
+                    continue
+            else:
+                raise Exception('unknown format, 7z or rar or winrar not found')
+        else:
+            raise Exception('unhandled format ' + str(args.format))
+    else:
+        if args.packer == 'zip':
+            args.packer = 'unzip'
+        unpacker = getattr(sys.modules[__name__], 'unpack_' + args.packer)
+        return unpacker(args)
+
+
+def split_archive_ext(filename):
+    name = os.path.basename(os.path.normpath(filename))
+    parts = name.split('.')
+    if len(parts) > 2 and parts[-2].lower() == 'tar':
+        return '.'.join(parts[:-2]), '.'.join(parts[-2:])
+    elif len(parts) > 1 and parts[0] != '':
+        return '.'.join(parts[:-1]), parts[-1]
+    else:
+        return name, ''
+
+
+def unpack_many(args):
+    """
+    Extract each of args.archive into its own directory under args.output.
+    args.jobs archives are extracted concurrently, at most args.io_jobs of them from the same device.
+    """
+    import copy, threading
+    from concurrent.futures import ThreadPoolExecutor
+
+    start = time.time()
+    archives = args.archive
+    outdir = args.output if args.output is not None else '.'
+    ensure_output_dir(outdir)
+    io_jobs = args.io_jobs or args.jobs
+    device_slots = {}
+    lock = threading.Lock()
+
+    def get_device_slot(archive):
+        try:
+            dev = os.stat(archive).st_dev
+        except OSError:
+            dev = None
+        with lock:
+            if dev not in device_slots:
+                device_slots[dev] = threading.BoundedSemaphore(io_jobs)
+            return device_slots[dev]
+
+    # output directory of each archive, a.tgz -> a/, or a-tgz/ if a.zip is also extracted,
+    # and a-tgz-2/ for another a.tgz
+    names = [split_archive_ext(x) for x in archives]
+    stems = [stem for stem, _ in names]
+    outputs = []
+    for stem, ext in names:
+        if stems.count(stem) > 1 and ext:
+            stem += '-' + ext
+        name, n = stem, 1
+        while name in outputs:
+            n += 1
+            name = '{}-{}'.format(stem, n)
+        outputs.append(name)
+    outputs = [os.path.join(outdir, x) for x in outputs]
+
+    def extract(i):
+        archive = archives[i]
+        job = copy.copy(args)
+        job.archive = archive
+        job.output = outputs[i]
+        with get_device_slot(archive):
+            try:
+                return unpack(job)
+            except Exception as e:
+                print('{}: {}'.format(archive, e), file=sys.stderr)
+                return 1
+
+    # big archives first
+    order = sorted(range(len(archives)), key=lambda i: -get_file_size(archives[i]))
+    with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as executor:
+        futures = {i: executor.submit(extract, i) for i in order}
+        retcodes = [futures[i].result() for i in range(len(archives))]
+
+    ret = report_failures(archives, retcodes)
+    failed = sum(1 for r in retcodes if r != 0)
+    print('extracted {} of {} archives, {} failed, in {:.2f}s'.format(
+        len(archives) - failed, len(archives), failed, time.time() - start), file=sys.stderr)
+    return ret
+## end unpack*
+
+
+## begin view*
+def view_tar(args):
+    tar_opt = ['tf', args.archive]
+    # tar bug
+    if args.format == 'tar.lzma':
+        tar_opt.append('--lzma')
+    if args.extra_opt is not None:
+        tar_opt += shlex.split(args.extra_opt)
+    if args.verbosity:
+        tar_opt.append('-v')
+
+    cmd = tar_with_decompressor(args, tar_opt)
+    return run_cmd(cmd, args.verbosity)
+
+
+def view_gz(args):
+    gz_cmd = local['gzip']
+    opt = ['--list']
+    if args.verbosity:
+        opt.append('-v')
+    if args.extra_opt is not None:
+        opt += shlex.split(args.extra_opt)
+
+    cmd = gz_cmd[opt]
+    if args.archive != '-':
+        cmd = cmd < args.archive
+    ret = run_cmd(cmd, args.verbosity)
+    if args.test:
+        opt.remove('--list')
+        opt.append('--test')
+        cmd = gz_cmd[opt]
+        if args.archive != '-':
+            cmd = cmd < args.archive
+        ret2 = run_cmd(cmd, args.verbosity)
+        ret = ret or ret2
+
+    return ret
+
+
+def view_7z_common(args, cmd_bin):
+    sevenz = local[cmd_bin]
+    if args.test:
+        opt = ['t', args.archive]
+    else:
+        opt = ['l', args.archive]
+        if args.verbosity > 1:
+            opt.append('-slt')
+
+    if args.format is not None:
+        opt.append('-t' + format_normalize(args.format))
+    if args.password is not None:
+        opt.append('-p' + args.password)
+    if args.extra_opt is not None:
+        opt += shlex.split(args.extra_opt)
+
+    cmd = sevenz[opt]
+    return run_cmd(cmd, args.verbosity)
+
+
+def view_7z(args):
+    return view_7z_common(args, '7z')
+
+
+def view_7zr(args):
+    return view_7z_common(args, '7zr')
+
+
+def view_rar_common(args, cmd_bin):
+    rar = local[cmd_bin]
+    if args.test:
+        opt = ['t', args.archive]
+    else:
+        if args.verbosity > 2:
+            opt = ['vta', args.archive]
+        elif args.verbosity > 1:
+            opt = ['vt', args.archive]
+        elif args.verbosity > 0:
+            opt = ['v', args.archive]
+        else:
+            opt = ['lb', args.archive]
+
+    if args.password is not None:
+        opt.append('-p' + args.password)
+    if args.extra_opt is not None:
+        opt += shlex.split(args.extra_opt)
+
+    cmd = rar[opt]
+    return run_cmd(cmd, args.verbosity)
+
+
+# winrar do not support listing
+
+def view_rar(args):
+    return view_rar_common(args, 'rar')
+
+
+def view_unrar(args):
+    return view_rar_common(args, 'unrar')
+
+
+def view_unzip(args):
+    unzip = local['unzip']
+    if args.test:
+        opt = ['-t']
+    else:
+        opt = ['-Z']
+        if args.verbosity > 1:
+            opt.append('-v')
+        elif args.verbosity > 0:
+            opt.append('-s')
+        else:
+            opt.append('-1')
+    opt.append('--')
+    opt.append(args.archive)
+
+    cmd = unzip[opt]
+    return run_cmd(cmd, args.verbosity)
+
+
+format2viewer = {
+    '7z' : (view_7z, view_7zr),
+    'rar': (view_unrar, view_rar, view_7z),
+    'zip': (view_unzip, view_7z),
+}
+
+
+record_fields = ('path', 'size', 'compressed_size', 'mtime', 'mode', 'crc', 'type')
+
+
+def parse_filemode(s):
+    """
+    Parse ls style mode string like '-rw-r--r--' to permission bits.
+    """
+    mode = 0
+    for i, c in enumerate(s[1:10]):
+        if c not in '-STl':
+            mode |= 1 << (8 - i)
+    for i, (c, bit) in enumerate(((s[3], 0o4000), (s[6], 0o2000), (s[9], 0o1000))):
+        if c in 'sStT':
+            mode |= bit
+    return mode
+
+
+def parse_mtime(s, fmt='%Y-%m-%d %H:%M:%S'):
+    # cut fraction of seconds and time zone
+    s = s[:len(time.strftime(fmt, time.gmtime(0)))]
+    try:
+        return int(time.mktime(time.strptime(s, fmt)))
+    except ValueError:
+        return None
+
+
+def new_record(path):
+    """
+    Record of an archive member, shared by all listing parsers.
+    """
+    return {'path': path, 'size': None, 'compressed_size': None, 'mtime': None,
+            'mode': None, 'crc': None, 'type': 'file'}
+
+
+def to_int(s):
+    try:
+        return int(s)
+    except ValueError:
+        return None
+
+
+def iter_7z_slt(lines):
+    """
+    Parse output of `7z l -slt`, yield records.
+    """
+    rec = None
+    started = False
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if line.startswith('----------'):
+            started = True  # members follow
+            continue
+        if not started:
+            continue
+        if line == '':
+            if rec is not None:
+                yield rec
+                rec = None
+            continue
+        key, sep, value = line.partition(' = ')
+        if not sep:
+            key, value = line.rstrip(' ='), ''
+        if key == 'Path':
+            rec = new_record(value)
+        elif rec is None:
+            continue
+        elif key == 'Size':
+            rec['size'] = to_int(value)
+        elif key == 'Packed Size':
+            rec['compressed_size'] = to_int(value)
+        elif key == 'Modified':
+            rec['mtime'] = parse_mtime(value)
+        elif key == 'CRC':
+            rec['crc'] = value.lower() or None
+        elif key == 'Folder' and value == '+':
+            rec['type'] = 'dir'
+        elif key == 'Attributes':
+            attrs = value.split()
+            if attrs and 'D' in attrs[0]:
+                rec['type'] = 'dir'
+            if len(attrs) > 1 and len(attrs[1]) == 10:
+                rec['mode'] = parse_filemode(attrs[1])
+                if attrs[1][0] == 'l':
+                    rec['type'] = 'symlink'
+    if rec is not None:
+        yield rec
+
+
+def iter_unrar_vt(lines):
+    """
+    Parse output of `unrar vt` (technical listing of rar 5), yield records.
+    """
+    rec = None
+    for line in lines:
+        key, sep, value = line.strip().partition(': ')
+        if not sep:
+            continue
+        if key == 'Name':
+            if rec is not None:
+                yield rec
+            rec = new_record(value)
+        elif rec is None:
+            continue
+        elif key == 'Type':
+            rec['type'] = {'Directory': 'dir', 'Symbolic link': 'symlink'}.get(value, 'file')
+        elif key == 'Size':
+            rec['size'] = to_int(value)
+        elif key == 'Packed size':
+            rec['compressed_size'] = to_int(value)
+        elif key == 'mtime':
+            rec['mtime'] = parse_mtime(value)
+        elif key == 'Attributes':
+            if len(value) == 10 and value[0] in '-dl':
+                rec['mode'] = parse_filemode(value)
+        elif key == 'CRC32':
+            rec['crc'] = value.lower()
+    if rec is not None:
+        yield rec
+
+
+def iter_tar_tv(lines):
+    """
+    Parse output of GNU `tar -tv --full-time`, yield records.
+    """
+    types = {'d': 'dir', 'l': 'symlink', 'h': 'hardlink', '-': 'file'}
+    for line in lines:
+        fields = line.rstrip('\r\n').split(None, 5)
+        if len(fields) < 6 or len(fields[0]) != 10:
+            continue
+        perm, _, size, day, clock, name = fields
+        kind = types.get(perm[0], 'other')
+        if kind == 'symlink':
+            name = name.rsplit(' -> ', 1)[0]
+        elif kind == 'hardlink':
+            name = name.rsplit(' link to ', 1)[0]
+        rec = new_record(name.rstrip('/') if kind == 'dir' else name)
+        rec['type'] = kind
+        rec['size'] = to_int(size)
+        rec['mtime'] = parse_mtime(day + ' ' + clock)
+        rec['mode'] = parse_filemode(perm)
+        yield rec
+
+
+def iter_zipinfo_v(lines):
+    """
+    Parse output of `unzip -Z -v`, yield records.
+    """
+    rec = None
+    want_name = False
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if line.startswith('Central directory entry #'):
+            if rec is not None:
+                yield rec
+            rec = None
+            want_name = True
+            continue
+        if want_name:
+            if line.strip('- ') != '':
+                # the name is indented by two spaces
+                rec = new_record(line[2:])
+                if rec['path'].endswith('/'):
+                    rec['type'] = 'dir'
+                    rec['path'] = rec['path'].rstrip('/')
+                want_name = False
+            continue
+        if rec is None:
+            continue
+        key, sep, value = line.strip().partition(':  ')
+        if not sep:
+            continue
+        value = value.strip()
+        if key == 'compressed size':
+            rec['compressed_size'] = to_int(value.split()[0])
+        elif key == 'uncompressed size':
+            rec['size'] = to_int(value.split()[0])
+        elif key == '32-bit CRC value (hex)':
+            rec['crc'] = value.lower()
+        elif key.startswith('file last modified on (DOS'):
+            rec['mtime'] = parse_mtime(value, '%Y %b %d %H:%M:%S')
+        elif key.startswith('Unix file attributes') and len(value) == 10:
+            rec['mode'] = parse_filemode(value)
+            if value[0] == 'l':
+                rec['type'] = 'symlink'
+            elif value[0] == 'd':
+                rec['type'] = 'dir'
+    if rec is not None:
+        yield rec
+
+
+def tarinfo_record(tarinfo):
+    rec = new_record(tarinfo.name)
+    rec['size'] = tarinfo.size
+    rec['mtime'] = int(tarinfo.mtime)
+    rec['mode'] = tarinfo.mode
+    if tarinfo.isdir():
+        rec['type'] = 'dir'
+    elif tarinfo.issym():
+        rec['type'] = 'symlink'
+    elif tarinfo.islnk():
+        rec['type'] = 'hardlink'
+    elif not tarinfo.isfile():
+        rec['type'] = 'other'
+    return rec
+
+
+def zipinfo_record(info):
+    import stat
+    rec = new_record(info.filename)
+    rec['size'] = info.file_size
+    rec['compressed_size'] = info.compress_size
+    rec['crc'] = '%08x' % info.CRC
+    rec['mtime'] = int(time.mktime(info.date_time + (0, 0, -1)))
+    if info.create_system == 3:     # unix
+        mode = info.external_attr >> 16
+        rec['mode'] = stat.S_IMODE(mode)
+        if stat.S_ISLNK(mode):
+            rec['type'] = 'symlink'
+    if info.is_dir():
+        rec['type'] = 'dir'
+        rec['path'] = info.filename.rstrip('/')
+    return rec
+
+
+def write_records(records, output_format, file=sys.stdout, fields=record_fields):
+    """
+    Write records as they are parsed, memory use does not grow with the archive.
+    """
+    import json
+    if output_format == 'csv':
+        import csv
+        writer = csv.DictWriter(file, fields, lineterminator='\n')
+        writer.writeheader()
+        for rec in records:
+            writer.writerow(rec)
+    elif output_format == 'jsonl':
+        for rec in records:
+            file.write(json.dumps(rec) + '\n')
+    else:   # json
+        sep = '['
+        for rec in records:
+            file.write(sep + '\n' + json.dumps(rec))
+            sep = ','
+        file.write('[]\n' if sep == '[' else '\n]\n')
+
+
+def run_records(cmd, parse, output_format, verbose=False):
+    if verbose:
+        print('running: ' + str(cmd), file=sys.stderr)
+    import subprocess, io
+    proc = cmd.popen(stdout=subprocess.PIPE, stderr=None)
+    with io.TextIOWrapper(proc.stdout, errors='surrogateescape') as lines:
+        write_records(parse(lines), output_format)
+    return proc.wait()
+
+
+def run_records_dry(cmd, parse, output_format, verbose=False):
+    print(str(cmd))
+    return 0
+
+
+def records_tar(args):
+    tar_opt = ['tvf', args.archive, '--full-time']
+    if args.format == 'tar.lzma':
+        tar_opt.append('--lzma')
+    return tar_with_decompressor(args, tar_opt), iter_tar_tv
+
+
+def records_7z_common(args, cmd_bin):
+    opt = ['l', '-slt']
+    if args.format is not None and args.format != 'unknown':
+        opt.append('-t' + format_normalize(args.format))
+    if args.password is not None:
+        opt.append('-p' + args.password)
+    return local[cmd_bin][opt + ['--', args.archive]], iter_7z_slt
+
+
+def records_7z(args):
+    return records_7z_common(args, '7z')
+
+
+def records_7zr(args):
+    return records_7z_common(args, '7zr')
+
+
+def records_rar_common(args, cmd_bin):
+    opt = ['vt', '-p' + args.password if args.password is not None else '-p-']
+    return local[cmd_bin][opt + ['--', args.archive]], iter_unrar_vt
+
+
+def records_rar(args):
+    return records_rar_common(args, 'rar')
+
+
+def records_unrar(args):
+    return records_rar_common(args, 'unrar')
+
+
+def records_unzip(args):
+    return local['unzip'][['-Z', '-v', '--', args.archive]], iter_zipinfo_v
+
+
+format2records = {
+    '7z' : (records_7z, records_7zr),
+    'rar': (records_unrar, records_rar, records_7z),
+    'zip': (records_unzip, records_7z),
+    'unknown': (records_7z,),
+}
+
+
+def view_records(args, fmt):
+    """
+    List archive as json, jsonl or csv records of the same fields for all formats.
+    """
+    if args.test:
+        raise Exception('--format-output can not be used with --test')
+    if use_builtin(args, fmt, builtin_tar_type | {'zip'}, lambda: get_file_size(args.archive)):
+        return view_records_builtin(args, fmt)
+
+    if args.packer not in {None, 'builtin'}:
+        packer = {'zip': 'unzip'}.get(args.packer, args.packer)
+        source = getattr(sys.modules[__name__], 'records_' + packer, None)
+        if source is None:
+            raise Exception("'%s' do not support listing" % args.packer)
+        sources = (source,)
+    elif fmt in tar_type:
+        sources = (records_tar,)
+    elif fmt in format2records:
+        sources = format2records[fmt]
+    else:
+        raise Exception("'%s' do not support listing" % fmt)
+
+    for source in sources:
+        try:
+            cmd, parse = source(args)
+        except CommandNotFound:
+            continue
+        return run_records(cmd, parse, args.format_output, args.verbosity)
+    else:
+        raise Exception(str(sources) + ' not found')
+
+
+def view(args):
+    fmt = args.format
+    if fmt is None:
+        fmt = identify(args.archive, cache=not args.no_cache)
+        if fmt != 'unknown':
+            args.format = fmt
+
+    fmt = format_normalize(fmt)
+    layers = delta_layers(args.archive, fmt) if not args.test else []
+    if layers:
+        return view_layers(args, fmt, layers)
+    if args.format_output is not None:
+        return view_records(args, fmt)
+    index = seekable_index(args, fmt) if args.threads > 1 and not args.test else None
+    if index is not None:
+        return view_seekable(args, index)
+    if use_builtin(args, fmt, builtin_tar_type | {'zip'}, lambda: get_file_size(args.archive)):
+        return view_builtin(args)
+    if args.packer == 'builtin':
+        args.packer = None
+
+    if args.packer is None:
+        # tar, tar.*
+        if fmt in tar_type:
+            return view_tar(args)
+        elif fmt == 'gz':
+            return view_gz(args)
+        # filter_type = {'gz', 'bz2', 'xz', 'lzma', 'Z', 'lz', 'lzo', 'zst', 'lz4'}
+        elif fmt in filter_type:
+            raise Exception("'%s' do not support listing" % fmt)
+        elif fmt in {'7z', 'rar', 'zip'}:
+            for viewer in format2viewer[fmt]:
+                try:
+                    return viewer(args)
+                except CommandNotFound:
+                    continue
+            else:
+                raise Exception(str(format2viewer[fmt])+' not found')
+        elif fmt == 'unknown':
+            for viewer in (view_7z,):
+                try:
+                    return viewer(args)
+                except CommandNotFound:
+                    continue
+            else:
+                raise Exception('unknown format, 7z or rar or winrar not found')
+        else:
+            raise Exception('unhandled format ' + str(args.format))
+    else:
+        if args.packer == 'zip':
+            args.packer = 'unzip'
+        viewer = getattr(sys.modules[__name__], 'view_' + args.packer)
+        return viewer(args)
+# end view*
+
+
+## begin test*
+test_fields = ('archive', 'format', 'status', 'size', 'decoded', 'seconds', 'mb_per_s', 'error')
+format2tester = {
+    '7z' : ('7z', '7zr'),
+    'rar': ('unrar', 'rar', '7z'),
+    'unknown': ('7z',),
+}
+
+
+class CountingReader:
+    def __init__(self, f):
+        self.f = f
+        self.count = 0
+
+    def read(self, n=-1):
+        data = self.f.read(n)
+        self.count += len(data)
+        return data
+
+
+class TailReader(CountingReader):
+    """
+    CountingReader remembering at least the last keep bytes read.
+    """
+    def __init__(self, f, keep):
+        super().__init__(f)
+        self.keep = keep
+        self.tail = bytearray()
+
+    def read(self, n=-1):
+        data = super().read(n)
+        self.tail += data
+        if len(self.tail) > 2 * self.keep:
+            del self.tail[:-self.keep]
+        return data
+
+
+def check_tar_end(stream, offset):
+    """
+    Raise if anything but zeros follows offset, where tarfile stopped reading headers.
+    tarfile takes a bad header for the end of archive, and ignores what follows the end.
+    """
+    import tarfile
+    unread = stream.count - offset
+    if unread > len(stream.tail):
+        raise Exception('cannot check end of archive at offset {}'.format(offset))
+    rest = bytes(stream.tail[len(stream.tail) - unread:])
+    if rest[:tarfile.BLOCKSIZE].count(0) != len(rest[:tarfile.BLOCKSIZE]):
+        raise Exception('invalid tar header at offset {}'.format(offset))
+    while rest:
+        if rest.count(0) != len(rest):
+            raise Exception('unexpected data after end of archive at offset {}'.format(offset))
+        rest = stream.read(copy_bufsize)
+
+
+def open_decoder(archive, suf):
+    """
+    Decompressed stream of archive and the external decoder process, None if decoded in-process.
+    """
+    if suf in builtin_filter_type:
+        return open_filter(suf, archive, 'rb'), None
+    import subprocess
+    with open(archive, 'rb') as src:
+        proc = get_decompressor(suf)['-c'].popen(stdin=src, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return proc.stdout, proc
+
+
+def drain(f):
+    while f.read(copy_bufsize):
+        pass
+
+
+def test_decode(args, archive, fmt):
+    """
+    Decode all data of archive, verifying checksums on the way. Return the number of bytes decoded.
+    """
+    if fmt in tar_type or fmt in filter_type:
+        if fmt == 'tar':
+            f, proc = open(archive, 'rb'), None
+        else:
+            f, proc = open_decoder(archive, fmt.split('.')[1] if fmt in tar_type else fmt)
+        try:
+            if fmt in tar_type:
+                import tarfile
+                # header checksums are verified by tarfile, data by the decoder
+                stream = TailReader(f, 2 * tarfile.RECORDSIZE)
+                with tarfile.open(fileobj=stream, mode='r|') as tar:
+                    for m in tar:
+                        if m.isreg():
+                            drain(tar.extractfile(m))
+                        tar.members = []
+                    check_tar_end(stream, tar.offset)
+            else:
+                stream = CountingReader(f)
+                drain(stream)
+        finally:
+            f.close()
+            if proc is not None:
+                proc.wait()
+        if proc is not None and proc.returncode != 0:
+            raise Exception(proc.stderr.read().decode('utf-8', 'replace').strip()
+                            or 'decompressor exited with {}'.format(proc.returncode))
+        return stream.count
+    elif fmt == 'zip':
+        import zipfile
+        total = 0
+        with zipfile.ZipFile(archive) as zf:
+            if args.password is not None:
+                zf.setpassword(args.password.encode())
+            for info in zf.infolist():
+                # CRC is checked when the member is read to the end
+                with zf.open(info) as f:
+                    stream = CountingReader(f)
+                    drain(stream)
+                    total += stream.count
+        return total
+    else:
+        import subprocess
+        for cmd_bin in format2tester.get(fmt, ('7z',)):
+            try:
+                tool = local[cmd_bin]
+            except CommandNotFound:
+                continue
+            opt = ['t']
+            if args.password is not None:
+                opt.append('-p' + args.password)
+            elif cmd_bin in {'rar', 'unrar'}:
+                opt.append('-p-')
+            proc = tool[opt + ['--', archive]].popen(stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                                     stderr=subprocess.STDOUT)
+            out, _ = proc.communicate()
+            if proc.returncode != 0:
+                lines = out.decode('utf-8', 'replace').strip().splitlines()
+                raise Exception(lines[-1] if lines else '{} exited with {}'.format(cmd_bin, proc.returncode))
+            return None
+        raise Exception('cannot test {} archive, {} not found'.format(fmt, ' or '.join(format2tester.get(fmt, ('7z',)))))
+
+
+def test_archive(args, archive):
+    rec = dict.fromkeys(test_fields)
+    rec['archive'] = archive
+    start = time.perf_counter()
+    try:
+        rec['size'] = os.path.getsize(archive)
+        fmt = args.format or identify(archive, cache=not args.no_cache)
+        rec['format'] = fmt = format_normalize(fmt)
+        rec['decoded'] = test_decode(args, archive, fmt)
+        rec['status'] = 'ok'
+    except Exception as e:
+        rec['status'] = 'fail'
+        rec['error'] = str(e) or type(e).__name__
+    rec['seconds'] = round(time.perf_counter() - start, 3)
+    if rec['size'] and rec['seconds'] > 0:
+        rec['mb_per_s'] = round(rec['size'] / rec['seconds'] / 1024 / 1024, 1)
+    return rec
+
+
+def test_archives(args):
+    """
+    Test args.archive, args.jobs of them concurrently, report each as it is done.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    start = time.time()
+    results = []
+
+    def report(records):
+        for rec in records:
+            results.append(rec)
+            if args.format_output is None:
+                if rec['status'] == 'ok':
+                    print('OK    {}  {} MB/s'.format(rec['archive'], rec['mb_per_s']), flush=True)
+                else:
+                    print('FAIL  {}: {}'.format(rec['archive'], rec['error']), flush=True)
+            yield rec
+
+    with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as executor:
+        records = report(executor.map(lambda x: test_archive(args, x), args.archive))
+        if args.format_output is None:
+            for _ in records:
+                pass
+        else:
+            write_records(records, args.format_output, fields=test_fields)
+
+    elapsed = time.time() - start
+    failed = sum(1 for rec in results if rec['status'] != 'ok')
+    size = sum(rec['size'] or 0 for rec in results)
+    print('tested {} archives, {} failed, {:.1f}MB in {:.2f}s, {:.1f}MB/s'.format(
+        len(results), failed, size / 1024 / 1024, elapsed, size / 1024 / 1024 / elapsed if elapsed > 0 else 0),
+        file=sys.stderr)
+    return 1 if failed else 0
+## end test*
+
+
+## begin builtin*
+# formats handled in-process with the standard library
+builtin_tar_type = {'tar', 'tar.gz', 'tar.bz2', 'tar.xz'}
+builtin_filter_type = {'gz', 'bz2', 'xz', 'lzma'}
+# archives or inputs smaller than this are handled in-process, where spawning tools costs more than the work
+builtin_threshold = 4 * 1024 * 1024
+copy_bufsize = 1024 * 1024
+# zip archives larger than this are extracted by --threads worker processes
+zip_parallel_threshold = 16 * 1024 * 1024
+
+
+def get_inputs_size(inputs, limit=None):
+    """
+    Total size of files under inputs, stop counting when limit is exceeded.
+    """
+    total = 0
+    for x in inputs:
+        if os.path.isdir(x):
+            for root, dirs, files in os.walk(x):
+                for name in files:
+                    total += get_file_size(os.path.join(root, name))
+                if limit is not None and total > limit:
+                    return total
+        else:
+            total += get_file_size(x)
+        if limit is not None and total > limit:
+            return total
+    return total
+
+
+def use_builtin(args, fmt, types, get_size):
+    if args.packer not in {None, 'builtin'}:
+        return False
+    if fmt not in types or args.password is not None or args.extra_opt is not None:
+        return False
+    if args.packer == 'builtin':
+        return True
+    return get_size() < builtin_threshold
+
+
+def open_filter(suf, filename, mode, level=None):
+    if filename == '-':
+        filename = sys.stdin.buffer if 'r' in mode else sys.stdout.buffer
+    kwds = compresslevel_kwds(suf, level)
+    if suf == 'gz':
+        import gzip
+        return gzip.open(filename, mode, **kwds)
+    elif suf == 'bz2':
+        import bz2
+        return bz2.open(filename, mode, **kwds)
+    else:
+        import lzma
+        return lzma.open(filename, mode, format=lzma.FORMAT_XZ if suf == 'xz' else lzma.FORMAT_ALONE, **kwds)
+
+
+def compresslevel_kwds(suf, level):
+    if level is None:
+        return {}
+    elif suf in {'xz', 'lzma'}:
+        return {'preset': level}
+    else:
+        return {'compresslevel': level}
+
+
+def open_plain(filename, mode):
+    if filename == '-':
+        return os.fdopen(os.dup((sys.stdin if 'r' in mode else sys.stdout).fileno()), mode)
+    return open(filename, mode)
+
+
+def copy_stream(src, dst):
+    import shutil
+    shutil.copyfileobj(src, dst, copy_bufsize)
+
+
+def run_builtin(desc, func, verbose=False):
+    if verbose:
+        print('running: builtin ' + desc, file=sys.stderr)
+    try:
+        func()
+        return 0
+    except Exception as e:
+        print('packer: {}'.format(e), file=sys.stderr)
+        return 1
+
+
+def run_builtin_dry(desc, func, verbose=False):
+    print('builtin ' + desc)
+    return 0
+
+
+def zip_is_symlink(info):
+    import stat
+    return info.create_system == 3 and stat.S_ISLNK(info.external_attr >> 16)
+
+
+def zip_extract(zf, infos, directory):
+    """
+    Extract infos from ZipFile zf to directory, restore permissions and timestamps like unzip.
+    Symlinks are created last like unzip does, so that no entry is written through one of them.
+    Permissions and timestamps of directories are restored after that, deepest first,
+    so that writing their contents does not change their mtime and read-only ones can be filled.
+    """
+    links, dirs = [], []
+    for info in infos:
+        if zip_is_symlink(info):
+            links.append(info)
+            continue
+        path = zf.extract(info, directory)
+        if info.is_dir():
+            dirs.append((info, path))
+        else:
+            zip_restore_attrs(info, path)
+    for info in links:
+        path = zip_target_path(info, directory)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.lexists(path) and not os.path.isdir(path):
+            os.remove(path)
+        os.symlink(zf.read(info).decode('utf-8', 'surrogateescape'), path)
+        mtime = time.mktime(info.date_time + (0, 0, -1))
+        if os.utime in os.supports_follow_symlinks:
+            os.utime(path, (mtime, mtime), follow_symlinks=False)
+    for info, path in sorted(dirs, key=lambda x: x[1], reverse=True):
+        zip_restore_attrs(info, path)
+
+
+def zip_restore_attrs(info, path):
+    mode = (info.external_attr >> 16) & 0o7777
+    if mode and info.create_system == 3:    # unix
+        os.chmod(path, mode)
+    mtime = time.mktime(info.date_time + (0, 0, -1))
+    os.utime(path, (mtime, mtime))
+
+
+def zip_target_path(info, directory):
+    """
+    Path where ZipFile.extract puts info, with the same sanitizing of the name.
+    """
+    arcname = info.filename.replace('/', os.path.sep)
+    if os.path.altsep:
+        arcname = arcname.replace(os.path.altsep, os.path.sep)
+    arcname = os.path.splitdrive(arcname)[1]
+    parts = [x for x in arcname.split(os.path.sep) if x not in ('', os.path.curdir, os.path.pardir)]
+    return os.path.join(directory, *parts)
+
+
+def zip_target_dir(info, directory):
+    """
+    Directory where ZipFile.extract puts info.
+    """
+    path = zip_target_path(info, directory)
+    return path if info.is_dir() else os.path.dirname(path)
+
+
+def zip_extract_worker(archive, password, indexes, directory):
+    import zipfile
+    with zipfile.ZipFile(archive) as zf:
+        if password is not None:
+            zf.setpassword(password.encode())
+        infos = zf.infolist()
+        zip_extract(zf, [infos[i] for i in indexes], directory)
+    return len(indexes)
+
+
+def unpack_zip_parallel(args):
+    """
+    Extract zip with args.threads worker processes, each with its own file handle.
+    Entries are partitioned by compressed size, largest first to the least loaded worker.
+    Directories are created first, their permissions and timestamps are restored at the end,
+    after symlinks are created.
+    """
+    import zipfile
+    from concurrent.futures import ProcessPoolExecutor
+
+    def extract():
+        with zipfile.ZipFile(args.archive) as zf:
+            infos = zf.infolist()
+            dirs = [x for x in infos if x.is_dir()]
+            links = [x for x in infos if zip_is_symlink(x)]
+            for path in sorted({zip_target_dir(x, args.output) for x in infos}):
+                os.makedirs(path, exist_ok=True)
+            if args.verbosity:
+                for info in infos:
+                    print(info.filename)
+
+            workers = min(args.threads, len(infos) - len(dirs) - len(links)) or 1
+            parts = [[] for _ in range(workers)]
+            loads = [0] * workers
+            files = (i for i, x in enumerate(infos) if not x.is_dir() and not zip_is_symlink(x))
+            for i in sorted(files, key=lambda i: -infos[i].compress_size):
+                w = loads.index(min(loads))
+                parts[w].append(i)
+                loads[w] += infos[i].compress_size + 1
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(zip_extract_worker, args.archive, args.password, part, args.output)
+                           for part in parts if part]
+                for future in futures:
+                    future.result()
+            zip_extract(zf, links, args.output)
+            zip_extract(zf, dirs, args.output)
+
+    args.output = ensure_output_dir(args.output)
+    return run_builtin('unzip {} with {} processes'.format(args.archive, args.threads), extract, args.verbosity)
+
+
+def pack_builtin(args):
+    fmt = args.format
+    if fmt in builtin_tar_type:
+        def pack_tar_builtin():
+            import tarfile
+            mode = 'w' if fmt == 'tar' else 'w:' + fmt.split('.')[1]
+            if args.archive == '-':
+                tar = tarfile.open(fileobj=sys.stdout.buffer, mode=mode.replace(':', '|'))
+            elif fmt == 'tar':
+                tar = tarfile.open(args.archive, mode)
+            else:
+                tar = tarfile.open(args.archive, mode, **compresslevel_kwds(fmt.split('.')[1], args.level))
+            with tar:
+                for x in args.inputs:
+                    tar.add(x, filter=print_tarinfo if args.verbosity else None)
+
+        return run_builtin('tar ' + fmt, pack_tar_builtin, args.verbosity)
+    elif fmt in builtin_filter_type:
+        def compress(x):
+            with open_plain(x, 'rb') as src, \
+                    open_filter(fmt, filter_output_name(args, x), 'wb', args.level) as dst:
+                copy_stream(src, dst)
+
+        retcodes = [run_builtin(fmt + ' ' + x, lambda: compress(x), args.verbosity) for x in args.inputs]
+        return report_failures(args.inputs, retcodes)
+    else:   # zip
+        duplicates = getattr(args, 'duplicates', None) or {}
+
+        def pack_zip_builtin():
+            import zipfile
+            with zipfile.ZipFile(args.archive, 'w', zipfile.ZIP_DEFLATED, compresslevel=args.level) as zf:
+                for x in args.inputs:
+                    paths = [x]
+                    if os.path.isdir(x):
+                        # follow symlinks to directories like zip -r, but not into a directory of their own path
+                        paths = []
+                        ancestors = {}
+                        for root, dirs, files in os.walk(x, followlinks=True):
+                            st = os.stat(root)
+                            key = (st.st_dev, st.st_ino)
+                            if key in ancestors.get(root, ()):
+                                dirs.clear()
+                                continue
+                            for name in dirs:
+                                ancestors[os.path.join(root, name)] = ancestors.get(root, frozenset()) | {key}
+                            dirs.sort()
+                            paths.append(root)
+                            # dangling symlinks are skipped like zip -r
+                            paths += [os.path.join(root, name) for name in sorted(files)
+                                      if os.path.exists(os.path.join(root, name))]
+                    for path in paths:
+                        if path in duplicates:
+                            continue
+                        if args.verbosity:
+                            print(path, file=sys.stderr)
+                        zf.write(path)
+                if duplicates:
+                    zf.writestr(dedup_manifest, dedup_manifest_data(duplicates))
+
+        return run_builtin('zip', pack_zip_builtin, args.verbosity)
+
+
+def print_tarinfo(tarinfo):
+    print(tarinfo.name, file=sys.stderr)
+    return tarinfo
+
+
+def unpack_builtin(args):
+    fmt = args.format
+    if fmt in builtin_tar_type:
+        def unpack_tar_builtin():
+            import tarfile
+            with tarfile.open(args.archive) as tar:
+                members = tar.getmembers()
+                if args.verbosity:
+                    for m in members:
+                        print(m.name)
+                if hasattr(tarfile, 'tar_filter'):
+                    tar.extractall(args.output, members, filter='tar')
+                else:
+                    tar.extractall(args.output, members)
+
+        args.output = ensure_output_dir(args.output)
+        return run_builtin('untar ' + args.archive, unpack_tar_builtin, args.verbosity)
+    elif fmt in builtin_filter_type:
+        def decompress():
+            with open_filter(fmt, args.archive, 'rb') as src, open_plain(args.output, 'wb') as dst:
+                copy_stream(src, dst)
+
+        return run_builtin(fmt + ' -d ' + args.archive, decompress, args.verbosity)
+    else:   # zip
+        def unpack_zip_builtin():
+            import zipfile
+            with zipfile.ZipFile(args.archive) as zf:
+                infos = zf.infolist()
+                if args.verbosity:
+                    for info in infos:
+                        print(info.filename)
+                zip_extract(zf, infos, args.output)
+
+        args.output = ensure_output_dir(args.output)
+        return run_builtin('unzip ' + args.archive, unpack_zip_builtin, args.verbosity)
+
+
+def view_builtin(args):
+    fmt = args.format
+    if fmt in builtin_tar_type:
+        import tarfile
+
+        def view_tar_builtin():
+            with tarfile.open(args.archive) as tar:
+                if args.test:
+                    # read all members, header checksums and compressed stream are verified on the way
+                    for m in tar:
+                        if m.isfile():
+                            f = tar.extractfile(m)
+                            while f.read(copy_bufsize):
+                                pass
+                    print('OK')
+                elif args.verbosity:
+                    tar.list(verbose=True)
+                else:
+                    for m in tar:
+                        print(m.name + ('/' if m.isdir() else ''))
+
+        return run_builtin('tar -t ' + args.archive, view_tar_builtin, args.verbosity)
+    else:   # zip
+        import zipfile
+
+        def view_zip_builtin():
+            with zipfile.ZipFile(args.archive) as zf:
+                if args.test:
+                    bad = zf.testzip()
+                    if bad is not None:
+                        raise Exception('bad CRC: ' + bad)
+                    print('OK')
+                elif args.verbosity:
+                    zf.printdir()
+                else:
+                    for name in zf.namelist():
+                        print(name)
+
+        return run_builtin('unzip -l ' + args.archive, view_zip_builtin, args.verbosity)
+
+
+def view_records_builtin(args, fmt):
+    def records():
+        if fmt in builtin_tar_type:
+            import tarfile
+            with tarfile.open(args.archive) as tar:
+                for m in tar:
+                    yield tarinfo_record(m)
+        else:
+            import zipfile
+            with zipfile.ZipFile(args.archive) as zf:
+                for info in zf.infolist():
+                    yield zipinfo_record(info)
+
+    return run_builtin('list ' + args.archive, lambda: write_records(records(), args.format_output), args.verbosity)
+## end builtin*
+
+
+## begin convert*
+def open_compressed_output(output, suf, args):
+    """
+    Return (file object, process), data written to the file object goes to output through the compressor of suf.
+    process is None if suf is None.
+    """
+    import subprocess
+    out = open_plain(output, 'wb')
+    if suf is None:
+        return out, None
+    compressor = get_compressor(suf, args.threads)[compressor_options(suf, args)]
+    proc = compressor.popen(stdin=subprocess.PIPE, stdout=out, stderr=None)
+    out.close()
+    return proc.stdin, proc
+
+
+def new_tarinfo(rec):
+    import tarfile
+    ti = tarfile.TarInfo(rec['path'])
+    ti.mtime = rec['mtime'] or 0
+    if rec['type'] == 'dir':
+        ti.type = tarfile.DIRTYPE
+        ti.mode = rec['mode'] or 0o755
+    else:
+        ti.size = rec['size'] or 0
+        ti.mode = rec['mode'] or 0o644
+    return ti
+
+
+def convert_members(args, members, out_suf):
+    """
+    Write (record, file object) pairs in members into tar args.output.
+    Members are streamed into the tar writer, nothing is written to the filesystem.
+    """
+    import tarfile
+    f, proc = open_compressed_output(args.output, out_suf, args)
+    try:
+        with tarfile.open(fileobj=f, mode='w|', format=tarfile.PAX_FORMAT) as tar:
+            for rec, fileobj in members:
+                if args.verbosity:
+                    print(rec['path'], file=sys.stderr)
+                ti = new_tarinfo(rec)
+                if rec['type'] == 'symlink':
+                    ti.type = tarfile.SYMTYPE
+                    ti.linkname = fileobj.read(ti.size).decode('utf-8', 'surrogateescape')
+                    ti.size = 0
+                    tar.addfile(ti)
+                elif ti.isdir():
+                    tar.addfile(ti)
+                else:
+                    tar.addfile(ti, fileobj)
+    finally:
+        f.close()
+        if proc is not None and proc.wait() != 0:
+            raise Exception('compressor exited with {}'.format(proc.returncode))
+
+
+def iter_zip_members(args):
+    import zipfile
+    with zipfile.ZipFile(args.archive) as zf:
+        if args.password is not None:
+            zf.setpassword(args.password.encode())
+        for info in zf.infolist():
+            rec = zipinfo_record(info)
+            if rec['type'] == 'dir':
+                yield rec, None
+            else:
+                with zf.open(info) as f:
+                    yield rec, f
+
+
+def iter_solid_members(args, cmd_bin, rar):
+    """
+    Stream members of 7z/rar archive from one `7z x -so` or `unrar p` process,
+    the output is split by member sizes from the listing.
+    """
+    import subprocess
+    tool = local[cmd_bin]
+    opt = ['-p' + args.password] if args.password is not None else (['-p-'] if rar else [])
+    if rar:
+        listing = tool[['vt'] + opt + ['--', args.archive]]()
+        records = list(iter_unrar_vt(listing.splitlines()))
+        extract_cmd = tool[['p', '-inul'] + opt + ['--', args.archive]]
+    else:
+        listing = tool[['l', '-slt'] + opt + ['--', args.archive]]()
+        records = list(iter_7z_slt(listing.splitlines()))
+        extract_cmd = tool[['x', '-so'] + opt + ['--', args.archive]]
+
+    proc = extract_cmd.popen(stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=None)
+    try:
+        for rec in records:
+            if rec['type'] == 'dir':
+                yield rec, None
+            else:
+                yield rec, proc.stdout
+        if proc.stdout.read(1):
+            raise Exception('member sizes in listing do not match the data of ' + args.archive)
+    finally:
+        proc.stdout.close()
+        proc.wait()
+
+
+def convert(args):
+    fmt = args.format
+    if fmt is None:
+        fmt = identify(args.archive, cache=not args.no_cache)
+    fmt = format_normalize(fmt)
+    out_fmt = get_format_by_filename(args.output)
+    if out_fmt not in tar_type:
+        raise Exception('can only convert to tar, tar.*')
+    out_suf = out_fmt.split('.')[1] if out_fmt != 'tar' else None
+
+    if fmt in tar_type:
+        # pure decompress | compress pipe
+        if fmt == 'tar':
+            cmd = None
+        else:
+            cmd = get_decompressor(fmt.split('.')[1]) < args.archive
+        if out_suf is not None:
+            compressor = get_compressor(out_suf, args.threads)[compressor_options(out_suf, args)]
+            cmd = compressor < args.archive if cmd is None else cmd | compressor
+        if cmd is None:
+            cmd = local['cat'][args.archive]
+        return run_cmd(cmd > args.output, args.verbosity)
+    elif fmt == 'zip':
+        members = lambda: iter_zip_members(args)
+    elif fmt == '7z':
+        members = lambda: iter_solid_members(args, '7z', False)
+    elif fmt == 'rar':
+        members = lambda: iter_solid_members(args, 'unrar', True)
+    else:
+        raise Exception('unhandled format ' + str(fmt))
+
+    return run_builtin('convert {} to {}'.format(args.archive, args.output),
+                       lambda: convert_members(args, members(), out_suf), args.verbosity)
+## end convert*
+
+
+## begin update*
+manifest_suffix = '.manifest.json'
+
+
+def hash_file(path):
+    import hashlib
+    h = hashlib.sha256()
+    if os.path.islink(path):
+        h.update(os.readlink(path).encode('utf-8', 'surrogateescape'))
+        return h.hexdigest()
+    with open(path, 'rb') as f:
+        while True:
+            buf = f.read(copy_bufsize)
+            if not buf:
+                break
+            h.update(buf)
+    return h.hexdigest()
+
+
+def scan_inputs(inputs):
+    """
+    Return {path: (size, mtime_ns)} of files under inputs.
+    """
+    result = {}
+
+    def add(path):
+        # paths are kept as tar writes them, member_name() gives the names of the other archivers
+        st = os.lstat(path)
+        result[path] = (st.st_size, st.st_mtime_ns)
+
+    for x in inputs:
+        if os.path.isdir(x) and not os.path.islink(x):
+            for root, dirs, files in os.walk(x):
+                for name in files:
+                    add(os.path.join(root, name))
+                for name in dirs:
+                    if os.path.islink(os.path.join(root, name)):
+                        add(os.path.join(root, name))
+        else:
+            add(x)
+    return result
+
+
+def load_manifest(archive):
+    import json
+    try:
+        with open(archive + manifest_suffix) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {'files': {}, 'layers': []}
+
+
+def save_manifest(archive, manifest):
+    import json
+    tmp = archive + manifest_suffix + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp, archive + manifest_suffix)
+
+
+def diff_manifest(files, current, threads):
+    """
+    Compare current scan with files of manifest, files are hashed only if size or mtime changed.
+    Return (new files of manifest, changed paths, removed paths).
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    suspects = [p for p, st in current.items() if p not in files or tuple(files[p][:2]) != st]
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+        hashes = dict(zip(suspects, executor.map(hash_file, suspects)))
+
+    new_files = {}
+    changed = []
+    for path, (size, mtime_ns) in sorted(current.items()):
+        if path in hashes:
+            digest = hashes[path]
+            if path not in files or files[path][2] != digest:
+                changed.append(path)
+        else:
+            digest = files[path][2]
+        new_files[path] = [size, mtime_ns, digest]
+    removed = sorted(set(files) - set(current))
+    return new_files, changed, removed
+
+
+def member_name(fmt, path):
+    """
+    Name of the file at path in an archive of fmt, tar only strips leading /, zip, 7z and rar strip ./ too.
+    """
+    if fmt in tar_type:
+        return path.lstrip('/')
+    return os.path.normpath(path).lstrip('/')
+
+
+def delete_members(args, fmt, paths):
+    names = [member_name(fmt, x) for x in paths]
+    if fmt == 'tar':
+        cmd = local['tar'][['--delete', '-f', args.archive, '--'] + names]
+    elif fmt == 'zip':
+        cmd = local['zip'][['-d', args.archive, '--'] + names]
+    elif fmt == '7z':
+        cmd = local['7z'][['d', args.archive, '--'] + names]
+    else:   # rar
+        cmd = local['rar'][['d', args.archive, '--'] + names]
+    return run_cmd(cmd, args.verbosity)
+
+
+def update(args):
+    """
+    Add new and changed files of args.inputs to args.archive, according to the manifest of last run.
+    Compressed tar can not be updated in place, a delta layer archive is written beside it.
+    """
+    import copy
+    fmt = args.format = format_normalize(args.format or get_format_by_filename(args.archive) or 'unknown')
+    if fmt not in tar_type | {'7z', 'zip', 'rar'}:
+        raise Exception('unhandled format ' + fmt)
+
+    manifest = load_manifest(args.archive)
+    current = scan_inputs(args.inputs)
+    files, changed, removed = diff_manifest(manifest['files'], current, args.threads)
+    if args.verbosity:
+        for path in changed:
+            print('changed: ' + path, file=sys.stderr)
+        for path in removed:
+            print('removed: ' + path, file=sys.stderr)
+
+    job = copy.copy(args)
+    ret = 0
+    if not os.path.exists(args.archive):
+        ret = pack(job)
+    elif not changed and not removed:
+        print('{} is up to date'.format(args.archive), file=sys.stderr)
+    elif fmt in tar_type - {'tar'}:
+        stem, ext = split_archive_ext(args.archive)
+        layer = os.path.join(os.path.dirname(args.archive),
+                             '{}.delta-{}.{}'.format(stem, len(manifest['layers']) + 1, ext))
+        if changed:
+            job.archive = layer
+            job.inputs = changed
+            ret = pack(job)
+        manifest['layers'].append({'archive': os.path.basename(layer) if changed else None,
+                                   'removed': removed})
+    elif fmt == 'tar':
+        # tar rf appends, delete old versions of changed files first
+        stale = removed + [p for p in changed if p in manifest['files']]
+        if stale:
+            ret = delete_members(args, fmt, stale)
+        if changed and ret == 0:
+            ret = run_cmd(local['tar'][['rf', args.archive, '--'] + changed], args.verbosity)
+    else:
+        if changed:
+            job.inputs = changed
+            ret = pack(job)     # 7z a, zip -r and rar a replace existing members
+        if removed and ret == 0:
+            ret = delete_members(args, fmt, removed)
+
+    if ret == 0 and not args.dry_run:
+        manifest['files'] = files
+        save_manifest(args.archive, manifest)
+    return ret
+
+
+def delta_layers(archive, fmt):
+    """
+    Delta layers written by update() beside compressed tar archive, as [(layer archive or None, removed names)]
+    in the order they apply.
+    """
+    if fmt not in tar_type - {'tar'} or archive == '-' or not os.path.exists(archive + manifest_suffix):
+        return []
+    directory = os.path.dirname(archive)
+    return [(os.path.join(directory, x['archive']) if x['archive'] else None,
+             [member_name(fmt, path) for path in x['removed']])
+            for x in load_manifest(archive)['layers']]
+
+
+def remove_members(directory, names):
+    for name in names:
+        path = os.path.normpath(name)
+        if os.path.isabs(path) or path == os.pardir or path.startswith(os.pardir + os.sep):
+            raise Exception('unsafe path ' + name)
+        path = os.path.join(directory, path)
+        if os.path.islink(path) or os.path.isfile(path):
+            os.remove(path)
+
+
+def unpack_layers(args, layers):
+    """
+    Bring the extracted base archive up to date, remove the files removed by each layer and extract the layer.
+    """
+    import copy
+    directory = args.output if args.output is not None else '.'
+    for layer, removed in layers:
+        if args.member:
+            removed = [x for x in removed if match_member(x, args.member)]
+        if removed:
+            ret = run_builtin('remove {} files removed by {}'.format(len(removed), layer or 'update'),
+                              lambda: remove_members(directory, removed), args.verbosity)
+            if ret != 0:
+                return ret
+        if layer is not None:
+            job = copy.copy(args)
+            job.archive = layer
+            job.output = directory
+            ret = unpack(job)
+            if ret != 0:
+                return ret
+    return 0
+
+
+def iter_tar_records(archive, suf):
+    import tarfile
+    f, proc = open_decoder(archive, suf)
+    try:
+        with tarfile.open(fileobj=f, mode='r|') as tar:
+            for m in tar:
+                yield tarinfo_record(m)
+    finally:
+        f.close()
+        if proc is not None:
+            proc.wait()
+    if proc is not None and proc.returncode != 0:
+        raise Exception(proc.stderr.read().decode('utf-8', 'replace').strip()
+                        or '{} exited with {}'.format(get_decompressor(suf), proc.returncode))
+
+
+def view_layers(args, fmt, layers):
+    """
+    List the members of the base archive and its delta layers as they are after extraction.
+    """
+    suf = fmt.split('.')[1]
+
+    def records():
+        entries = {}
+        for archive, removed in [(args.archive, [])] + layers:
+            for name in removed:
+                entries.pop(name, None)
+            if archive is not None:
+                for rec in iter_tar_records(archive, suf):
+                    entries.pop(rec['path'], None)  # keep the order of the last layer
+                    entries[rec['path']] = rec
+        return entries.values()
+
+    def list_members():
+        if args.format_output is not None:
+            return write_records(records(), args.format_output)
+        for rec in records():
+            if args.verbosity:
+                print('{:o} {:>12} {} {}'.format(
+                    rec['mode'] or 0, rec['size'] or 0,
+                    time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(rec['mtime'] or 0)), rec['path']))
+            else:
+                print(rec['path'])
+
+    return run_builtin('list {} with {} delta layers'.format(args.archive, len(layers)), list_members,
+                       args.verbosity)
+## end update*
+
+
+## begin index*
+index_suffix = '.index.json'
+index_type = {'tar', 'tar.gz', 'tar.bz2', 'tar.xz'}
+index_spacing = 1 << 20     # min decompressed bytes between two checkpoints
+
+
+def read_varint(buf, pos):
+    value = shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        value |= (b & 0x7f) << shift
+        shift += 7
+        if not b & 0x80:
+            return value, pos
+
+
+def encode_varint(value):
+    out = bytearray()
+    while value >= 0x80:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def parse_xz_streams(f):
+    """
+    Read stream footers and indexes of xz file f from its end, return its streams,
+    each with blocks of (compressed offset, decompressed offset, unpadded size, size).
+    """
+    f.seek(0, os.SEEK_END)
+    end = f.tell()
+    streams = []
+    while end > 0:
+        if end < 12:
+            raise Exception('bad xz stream footer')
+        f.seek(end - 4)
+        if f.read(4) == b'\0\0\0\0':    # stream padding
+            end -= 4
+            continue
+        f.seek(end - 12)
+        footer = f.read(12)
+        if footer[10:] != b'YZ':
+            raise Exception('bad xz stream footer')
+        index_start = end - 12 - (int.from_bytes(footer[4:8], 'little') + 1) * 4
+        f.seek(index_start)
+        index = f.read(end - 12 - index_start)
+        count, pos = read_varint(index, 1)
+        records = []
+        for _ in range(count):
+            unpadded, pos = read_varint(index, pos)
+            size, pos = read_varint(index, pos)
+            records.append((unpadded, size))
+        start = index_start - sum((unpadded + 3) & ~3 for unpadded, _ in records) - 12
+        streams.append({'start': start, 'end': end, 'index_start': index_start,
+                        'flags': footer[8:10], 'records': records})
+        end = start
+
+    streams.reverse()
+    uoff = 0
+    for stream in streams:
+        coff = stream['start'] + 12
+        stream['blocks'] = []
+        for unpadded, size in stream['records']:
+            stream['blocks'].append((coff, uoff, unpadded, size))
+            coff += (unpadded + 3) & ~3
+            uoff += size
+    return streams
+
+
+def xz_resume_input(f, coff):
+    """
+    Input to restart xz decoding at the block at coff: stream header, the remaining blocks of
+    the stream and an index of these blocks, so that the decoder verifies the stream end as usual.
+    Return the input and the offset where the following stream starts.
+    """
+    from zlib import crc32
+
+    def crc(data):
+        return crc32(data).to_bytes(4, 'little')
+
+    for stream in parse_xz_streams(f):
+        if stream['start'] == coff:
+            return [], coff
+        for i, block in enumerate(stream['blocks']):
+            if block[0] != coff:
+                continue
+            flags, records = stream['flags'], stream['records'][i:]
+            header = b'\xfd7zXZ\0' + flags + crc(flags)
+            index = b'\0' + encode_varint(len(records))
+            index += b''.join(encode_varint(unpadded) + encode_varint(size) for unpadded, size in records)
+            index += b'\0' * (-len(index) % 4)
+            index += crc(index)
+            backward = (len(index) // 4 - 1).to_bytes(4, 'little')
+            footer = crc(backward + flags) + backward + flags + b'YZ'
+            return [header, (coff, stream['index_start']), index + footer], stream['end']
+    raise Exception('no xz block at offset {}'.format(coff))
+
+
+def new_decompressor(suf):
+    if suf == 'gz':
+        import zlib
+        return zlib.decompressobj(31)
+    elif suf == 'bz2':
+        import bz2
+        return bz2.BZ2Decompressor()
+    else:
+        import lzma
+        return lzma.LZMADecompressor(lzma.FORMAT_XZ)
+
+
+class CheckpointReader:
+    """
+    Decompressed stream of gz, bz2 or xz file f, read from checkpoint (coff, uoff).
+    A fresh decompressor is started at each gzip member, bz2 stream and xz stream,
+    on_stream(coff, uoff) is called at each of them.
+    Other formats are decompressed by the external tool from coff to the end of file.
+    """
+
+    def __init__(self, f, suf, coff=0, uoff=0, on_stream=None):
+        self.f = f
+        self.suf = suf
+        self.pos = uoff
+        self.cpos = coff
+        self.segments = []
+        self.on_stream = on_stream
+        self.buf = b''
+        self.bufpos = 0
+        self.inp = b''
+        self.proc = None
+        if suf not in {'gz', 'bz2', 'xz'}:
+            import subprocess
+            with open(f.name, 'rb') as src:
+                src.seek(coff)
+                self.proc = get_decompressor(suf)['-c'].popen(stdin=src, stdout=subprocess.PIPE)
+            return
+        if suf == 'xz' and coff != 0:
+            self.segments, self.cpos = xz_resume_input(f, coff)
+        self.new_stream()
+
+    def close(self):
+        if self.proc is not None:
+            self.proc.stdout.close()
+            self.proc.kill()
+            self.proc.wait()
+            self.proc = None
+
+    def new_stream(self):
+        if self.on_stream is not None:
+            self.on_stream(self.cpos - len(self.inp), self.pos)
+        self.dec = new_decompressor(self.suf)
+
+    def read_raw(self):
+        if self.segments:
+            seg = self.segments.pop(0)
+            if isinstance(seg, bytes):
+                return seg
+            start, end = seg
+            self.f.seek(start)
+            data = self.f.read(min(copy_bufsize, end - start))
+            if start + len(data) < end and data:
+                self.segments.insert(0, (start + len(data), end))
+            return data
+        self.f.seek(self.cpos)
+        data = self.f.read(copy_bufsize)
+        self.cpos += len(data)
+        return data
+
+    def decompress(self):
+        """
+        Decompress the next chunk into self.buf, return False at the end of file.
+        """
+        if self.proc is not None:
+            out = self.proc.stdout.read(copy_bufsize)
+            self.buf, self.bufpos = out, 0
+            return len(out) > 0
+        while True:
+            if self.dec.eof:
+                self.inp = self.inp.lstrip(b'\0')
+                while not self.inp:
+                    data = self.read_raw()
+                    if not data:
+                        return False
+                    self.inp = data.lstrip(b'\0')
+                self.new_stream()
+            if not self.inp and (self.suf == 'gz' or self.dec.needs_input):
+                self.inp = self.read_raw()
+                if not self.inp:
+                    raise EOFError('compressed file ended before the end-of-stream marker was reached')
+            if self.suf == 'gz':
+                out = self.dec.decompress(self.inp, copy_bufsize)
+                self.inp = self.dec.unconsumed_tail
+            elif self.dec.needs_input:
+                out = self.dec.decompress(self.inp, copy_bufsize)
+                self.inp = b''
+            else:
+                out = self.dec.decompress(b'', copy_bufsize)
+            if self.dec.eof:
+                self.inp = self.dec.unused_data
+            if out:
+                self.buf, self.bufpos = out, 0
+                return True
+
+    def read(self, n=-1):
+        chunks = []
+        while n != 0:
+            if self.bufpos == len(self.buf) and not self.decompress():
+                break
+            end = len(self.buf) if n < 0 else min(len(self.buf), self.bufpos + n)
+            chunks.append(self.buf[self.bufpos:end])
+            n -= end - self.bufpos
+            self.pos += end - self.bufpos
+            self.bufpos = end
+        return b''.join(chunks)
+
+    def skip(self, n):
+        while n > 0:
+            data = self.read(min(n, copy_bufsize))
+            if not data:
+                raise EOFError('unexpected end of ' + self.suf + ' stream')
+            n -= len(data)
+
+
+class LimitedReader:
+    def __init__(self, f, size):
+        self.f = f
+        self.remaining = size
+
+    def read(self, n=-1):
+        if n is None or n < 0 or n > self.remaining:
+            n = self.remaining
+        data = self.f.read(n)
+        self.remaining -= len(data)
+        return data
+
+
+def cached_index_path(archive):
+    import hashlib
+    key = hashlib.sha1(os.path.abspath(archive).encode('utf-8', 'surrogateescape')).hexdigest()
+    return os.path.join(get_cache_dir(), 'index', key + '.json')
+
+
+def load_index(archive):
+    import json
+    st = os.stat(archive)
+    for path in (archive + index_suffix, cached_index_path(archive)):
+        try:
+            with open(path) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if index.get('size') == st.st_size and index.get('mtime') == st.st_mtime_ns:
+            return index
+    index = read_embedded_index(archive)
+    if index is not None:
+        index['size'], index['mtime'] = st.st_size, st.st_mtime_ns
+    return index
+
+
+def save_index(archive, index):
+    """
+    Save index beside the archive, or in the cache dir if the archive dir is not writable.
+    """
+    import json
+    for path in (archive + index_suffix, cached_index_path(archive)):
+        tmp = path + '.tmp'
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            with open(tmp, 'w') as f:
+                json.dump(index, f, separators=(',', ':'))
+            os.replace(tmp, path)
+            return path
+        except OSError:
+            continue
+    return None
+
+
+def match_member(name, patterns):
+    """
+    Shell style match, `*` matches `/` too, and a directory matches everything under it like tar.
+    """
+    import fnmatch
+    name = name[2:] if name.startswith('./') else name
+    name = name.rstrip('/')
+    for pattern in patterns:
+        pattern = pattern[2:] if pattern.startswith('./') else pattern
+        pattern = pattern.rstrip('/')
+        if fnmatch.fnmatchcase(name, pattern) or fnmatch.fnmatchcase(name, pattern + '/*'):
+            return True
+    return False
+
+
+def extract_tarinfo(tar, tarinfo, directory):
+    import tarfile
+    if hasattr(tarfile, 'tar_filter'):
+        tar.extract(tarinfo, directory, filter='tar')
+    else:
+        tar.extract(tarinfo, directory)
+
+
+def restore_dirs(dirs, directory):
+    """
+    Create directories after their contents, so that their timestamps are kept.
+    """
+    import tarfile
+    for tarinfo in sorted(dirs, key=lambda x: x.name, reverse=True):
+        if hasattr(tarfile, 'tar_filter'):
+            tarinfo = tarfile.tar_filter(tarinfo, directory)
+        path = os.path.join(directory, tarinfo.name)
+        os.makedirs(path, exist_ok=True)
+        if tarinfo.mode is not None:
+            os.chmod(path, tarinfo.mode & 0o7777)
+        if tarinfo.mtime is not None:
+            os.utime(path, (tarinfo.mtime, tarinfo.mtime))
+
+
+def build_index(args, fmt, directory):
+    """
+    Read the archive once, record offsets of members in the tar stream and decompressor checkpoints.
+    Members matching args.member are extracted to directory on the way.
+    """
+    import tarfile
+    suf = fmt.partition('.')[2]
+    st = os.stat(args.archive)
+    index = {'format': fmt, 'size': st.st_size, 'mtime': st.st_mtime_ns, 'checkpoints': [[0, 0]], 'members': []}
+    checkpoints, members = index['checkpoints'], index['members']
+    dirs = []
+
+    def on_stream(coff, uoff):
+        if uoff - checkpoints[-1][1] >= index_spacing:
+            checkpoints.append([coff, uoff])
+
+    with open(args.archive, 'rb') as f:
+        if suf == 'xz':
+            for stream in parse_xz_streams(f):
+                for coff, uoff, _, _ in stream['blocks']:
+                    on_stream(coff, uoff)
+            fileobj = CheckpointReader(f, suf)
+        elif suf:
+            fileobj = CheckpointReader(f, suf, on_stream=on_stream)
+        else:
+            fileobj = f
+        with tarfile.open(fileobj=fileobj, mode='r|' if suf else 'r:') as tar:
+            for m in tar:
+                if members:
+                    members[-1][2] = m.offset
+                members.append([m.name, m.offset, None])
+                if match_member(m.name, args.member):
+                    if args.verbosity:
+                        print(m.name)
+                    if m.isdir():
+                        dirs.append(m)
+                    else:
+                        extract_tarinfo(tar, m, directory)
+                # names and offsets are kept in the index, not in tar
+                tar.members = []
+            if members:
+                members[-1][2] = tar.offset
+    restore_dirs(dirs, directory)
+    return index
+
+
+def extract_indexed(args, index, directory):
+    """
+    Extract members matching args.member, decompress from the nearest checkpoint before each.
+    """
+    import tarfile, bisect
+    suf = index['format'].partition('.')[2]
+    checkpoints = index['checkpoints']
+    starts = [uoff for _, uoff in checkpoints]
+    selected = sorted((x for x in index['members'] if match_member(x[0], args.member)), key=lambda x: x[1])
+    if not selected:
+        raise Exception('no member matches ' + ' '.join(args.member))
+
+    dirs = []
+    with open(args.archive, 'rb') as f:
+        reader = None
+        for name, offset, end in selected:
+            if suf:
+                coff, uoff = checkpoints[bisect.bisect_right(starts, offset) - 1]
+                if reader is None or reader.pos > offset or uoff > reader.pos:
+                    if reader is not None:
+                        reader.close()
+                    reader = CheckpointReader(f, suf, coff, uoff)
+                reader.skip(offset - reader.pos)
+            else:
+                f.seek(offset)
+                reader = f
+            with tarfile.open(fileobj=LimitedReader(reader, end - offset), mode='r|') as tar:
+                m = tar.next()
+                if args.verbosity:
+                    print(m.name)
+                if m.isdir():
+                    dirs.append(m)
+                else:
+                    extract_tarinfo(tar, m, directory)
+        if suf and reader is not None:
+            reader.close()
+    restore_dirs(dirs, directory)
+
+
+def unpack_members(args, fmt):
+    """
+    Extract members matching args.member. tar, tar.{gz,bz2,xz} are read with the sidecar index
+    ARCHIVE.index.json, built on first access, seekable tar.zst with its embedded index,
+    zip is read with its central directory.
+    """
+    directory = args.output if args.output is not None else '.'
+    ensure_output_dir(directory)
+    desc = 'extract ' + args.archive + ' ' + ' '.join(shlex.quote(x) for x in args.member)
+
+    if fmt == 'zip':
+        import zipfile
+
+        def extract_zip():
+            with zipfile.ZipFile(args.archive) as zf:
+                if args.password is not None:
+                    zf.setpassword(args.password.encode())
+                infos = [x for x in zf.infolist() if match_member(x.filename, args.member)]
+                if not infos:
+                    raise Exception('no member matches ' + ' '.join(args.member))
+                if args.verbosity:
+                    for info in infos:
+                        print(info.filename)
+                zip_extract(zf, infos, directory)
+
+        return run_builtin(desc, extract_zip, args.verbosity)
+
+    def extract():
+        index = None if args.no_cache else load_index(args.archive)
+        if index is not None:
+            return extract_indexed(args, index, directory)
+        index = build_index(args, fmt, directory)
+        path = save_index(args.archive, index)
+        if args.verbosity:
+            print('index of {} members, {} checkpoints saved to {}'.format(
+                len(index['members']), len(index['checkpoints']), path), file=sys.stderr)
+        if not any(match_member(name, args.member) for name, _, _ in index['members']):
+            raise Exception('no member matches ' + ' '.join(args.member))
+
+    return run_builtin(desc, extract, args.verbosity)
+## end index*
+
+
+## begin seekable*
+seekable_type = {'tar.gz', 'tar.xz', 'tar.zst'}
+seekable_block_size = 4 << 20
+gzip_index_id = b'PX'       # FEXTRA subfields of empty gzip members holding the index
+gzip_footer_id = b'PI'
+gzip_footer_size = 42
+zstd_index_magic = 0x184D2A50
+zstd_seek_table_magic = 0x184D2A5E
+zstd_seekable_magic = 0x8F92EAB1
+
+
+def compress_block(suf, data, level=None):
+    if suf == 'gz':
+        import zlib
+        c = zlib.compressobj(6 if level is None else level, zlib.DEFLATED, 31)
+        return c.compress(data) + c.flush()
+    elif suf == 'xz':
+        import lzma
+        return lzma.compress(data, lzma.FORMAT_XZ, preset=level)
+    else:
+        import subprocess
+        opt = ['-q', '-c'] + (['-{}'.format(level)] if level is not None else [])
+        proc = local['zstd'][opt].popen(stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        out, _ = proc.communicate(data)
+        if proc.returncode != 0:
+            raise Exception('zstd failed')
+        return out
+
+
+def decompress_block(suf, data):
+    if suf == 'gz':
+        import zlib
+        out = []
+        while data:
+            d = zlib.decompressobj(31)
+            out.append(d.decompress(data))
+            if not d.eof:
+                raise EOFError('truncated gzip member')
+            data = d.unused_data
+        return b''.join(out)
+    elif suf == 'xz':
+        import lzma
+        return lzma.decompress(data, lzma.FORMAT_XZ)
+    else:
+        import subprocess
+        proc = get_decompressor(suf)['-c'].popen(stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        out, _ = proc.communicate(data)
+        if proc.returncode != 0:
+            raise Exception('zstd failed')
+        return out
+
+
+class BlockWriter:
+    """
+    File object compressing each seekable_block_size bytes written to it independently.
+    Blocks are compressed by a thread pool and written in order, their offsets are kept in blocks.
+    """
+
+    def __init__(self, out, suf, level, threads):
+        from concurrent.futures import ThreadPoolExecutor
+        self.out = out
+        self.suf = suf
+        self.level = level
+        self.threads = max(1, threads)
+        self.executor = ThreadPoolExecutor(max_workers=self.threads)
+        self.pending = []
+        self.buf = bytearray()
+        self.pos = 0
+        self.cpos = 0
+        self.blocks = []    # [(compressed offset, offset, compressed size, size)]
+
+    def write(self, data):
+        self.buf += data
+        while len(self.buf) >= seekable_block_size:
+            self.submit(bytes(self.buf[:seekable_block_size]))
+            del self.buf[:seekable_block_size]
+        return len(data)
+
+    def submit(self, block):
+        self.pending.append((self.pos, len(block), self.executor.submit(compress_block, self.suf, block, self.level)))
+        self.pos += len(block)
+        # bound memory use to a few blocks per thread
+        while len(self.pending) > 2 * self.threads:
+            self.drain()
+
+    def drain(self):
+        pos, size, future = self.pending.pop(0)
+        data = future.result()
+        self.out.write(data)
+        self.blocks.append((self.cpos, pos, len(data), size))
+        self.cpos += len(data)
+
+    def close(self):
+        if self.buf:
+            self.submit(bytes(self.buf))
+            self.buf = bytearray()
+        while self.pending:
+            self.drain()
+        self.executor.shutdown()
+
+
+def embed_index(suf, index, blocks):
+    """
+    Trailer holding the index, skipped by gzip and zstd: empty gzip members with FEXTRA,
+    or a skippable zstd frame followed by a zstd seekable format seek table.
+    """
+    import json, zlib, struct
+    payload = zlib.compress(json.dumps(index, separators=(',', ':')).encode())
+    if suf == 'gz':
+        def empty_member(subfield, data):
+            extra = subfield + struct.pack('<H', len(data)) + data
+            return b'\x1f\x8b\x08\x04\0\0\0\0\0\xff' + struct.pack('<H', len(extra)) + extra + b'\x03\x00' + b'\0' * 8
+
+        chunks = [payload[i:i + 65000] for i in range(0, len(payload), 65000)]
+        trailer = b''.join(empty_member(gzip_index_id, x) for x in chunks)
+        return trailer + empty_member(gzip_footer_id, struct.pack('<QQ', len(trailer), len(payload)))
+    else:   # zst
+        frame = struct.pack('<II', zstd_index_magic, len(payload)) + payload
+        table = b''.join(struct.pack('<II', csize, size) for _, _, csize, size in blocks)
+        table += struct.pack('<IBI', len(blocks), 0, zstd_seekable_magic)
+        return frame + struct.pack('<II', zstd_seek_table_magic, len(table)) + table
+
+
+def read_embedded_index(archive):
+    import json, zlib, struct
+    with open(archive, 'rb') as f:
+        magic = f.read(4)
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        if magic[:2] == b'\x1f\x8b' and end > gzip_footer_size:
+            f.seek(end - gzip_footer_size)
+            footer = f.read(gzip_footer_size)
+            if footer[12:16] != gzip_footer_id + b'\x10\x00':
+                return None
+            trailer_size, payload_size = struct.unpack('<QQ', footer[16:32])
+            f.seek(end - gzip_footer_size - trailer_size)
+            trailer = f.read(trailer_size)
+            payload = []
+            pos = 0
+            while pos < len(trailer):
+                xlen, = struct.unpack('<H', trailer[pos + 10:pos + 12])
+                size, = struct.unpack('<H', trailer[pos + 14:pos + 16])
+                payload.append(trailer[pos + 16:pos + 16 + size])
+                pos += 12 + xlen + 10
+            payload = b''.join(payload)
+        elif magic == b'\x28\xb5\x2f\xfd' and end > 17:
+            f.seek(end - 9)
+            count, _, seekable_magic = struct.unpack('<IBI', f.read(9))
+            if seekable_magic != zstd_seekable_magic:
+                return None
+            f.seek(end - 9 - 8 * count - 8)
+            magic, table_size = struct.unpack('<II', f.read(8))
+            data_end = sum(struct.unpack('<II', f.read(8))[0] for _ in range(count))
+            f.seek(data_end)
+            magic, payload_size = struct.unpack('<II', f.read(8))
+            if magic != zstd_index_magic:
+                return None
+            payload = f.read(payload_size)
+        else:
+            return None
+    try:
+        return json.loads(zlib.decompress(payload))
+    except (zlib.error, ValueError):
+        return None
+
+
+def pack_seekable(args):
+    """
+    Write tar.gz, tar.xz or tar.zst of independently compressed blocks with an index of members,
+    the index is embedded in tar.gz and tar.zst and saved to ARCHIVE.index.json.
+    """
+    import tarfile
+    fmt = args.format
+    suf = fmt.split('.')[1]
+
+    def walk(x):
+        yield x
+        if os.path.isdir(x) and not os.path.islink(x):
+            for root, dirs, files in os.walk(x):
+                dirs.sort()
+                for name in sorted(dirs + files):
+                    path = os.path.join(root, name)
+                    if name in dirs and os.path.islink(path):
+                        dirs.remove(name)   # do not follow
+                    yield path
+
+    def pack_tar_seekable():
+        out = sys.stdout.buffer if args.archive == '-' else open(args.archive, 'wb')
+        try:
+            writer = BlockWriter(out, suf, args.level, args.threads)
+            members = []
+            with tarfile.open(fileobj=writer, mode='w|') as tar:
+                for x in args.inputs:
+                    for path in walk(x):
+                        if args.verbosity:
+                            print(path, file=sys.stderr)
+                        offset = tar.offset
+                        tar.add(path, recursive=False)
+                        members.append([tar.members[-1].name, offset, tar.offset])
+                        tar.members = []
+            writer.close()
+            index = {'format': fmt, 'seekable': True, 'data_end': writer.cpos,
+                     'checkpoints': [[coff, uoff] for coff, uoff, _, _ in writer.blocks], 'members': members}
+            if suf != 'xz':
+                out.write(embed_index(suf, index, writer.blocks))
+        finally:
+            if out is not sys.stdout.buffer:
+                out.close()
+        if args.archive != '-':
+            st = os.stat(args.archive)
+            index['size'], index['mtime'] = st.st_size, st.st_mtime_ns
+            save_index(args.archive, index)
+
+    return run_builtin('tar ' + fmt + ' --seekable', pack_tar_seekable, args.verbosity)
+
+
+def iter_seekable_blocks(args, index):
+    """
+    Yield decompressed blocks of seekable archive in order, args.threads blocks are decompressed at once.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    suf = index['format'].split('.')[1]
+    bounds = [coff for coff, _ in index['checkpoints']] + [index['data_end']]
+    threads = max(1, args.threads)
+
+    def decode(i):
+        with open(args.archive, 'rb') as f:
+            f.seek(bounds[i])
+            return decompress_block(suf, f.read(bounds[i + 1] - bounds[i]))
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        pending = []
+        for i in range(len(bounds) - 1):
+            pending.append(executor.submit(decode, i))
+            if len(pending) > 2 * threads:
+                yield pending.pop(0).result()
+        for future in pending:
+            yield future.result()
+
+
+def run_seekable(args, index, tar_opt):
+    """
+    Feed blocks decompressed in parallel to tar.
+    """
+    import subprocess
+    cmd = local['tar'][tar_opt]
+
+    def feed():
+        proc = cmd.popen(stdin=subprocess.PIPE, stdout=None, stderr=None)
+        try:
+            for block in iter_seekable_blocks(args, index):
+                proc.stdin.write(block)
+        finally:
+            proc.stdin.close()
+            ret = proc.wait()
+        if ret != 0:
+            raise Exception('tar exited with {}'.format(ret))
+
+    return run_builtin('decompress {} blocks of {} with {} threads | {}'.format(
+        len(index['checkpoints']), args.archive, args.threads, cmd), feed, args.verbosity)
+
+
+def seekable_index(args, fmt):
+    if fmt not in seekable_type or args.packer not in {None, 'builtin'} or args.archive == '-':
+        return None
+    index = load_index(args.archive)
+    return index if index is not None and index.get('seekable') else None
+
+
+def unpack_seekable(args, index):
+    args.output = ensure_output_dir(args.output)
+    tar_opt = ['xf', '-', '-C', args.output]
+    if args.verbosity:
+        tar_opt.append('-v')
+    return run_seekable(args, index, tar_opt)
+
+
+def view_seekable(args, index):
+    tar_opt = ['tf', '-']
+    if args.verbosity:
+        tar_opt.append('-v')
+    return run_seekable(args, index, tar_opt)
+## end seekable*
+
+
+## begin meter*
+meter_interval = 1.0    # seconds between progress reports on a terminal
+meter_log_interval = 10.0   # and in a log file
+
+
+def metered(args, fmt):
+    """
+    Whether --progress or --stats-file meter this tar, tar.* or filter command.
+    Only the commands are metered, small archives are not handled in-process then, unless --packer builtin.
+    """
+    return (args.progress or args.stats_file is not None) and fmt in tar_type | filter_type \
+        and args.packer != 'builtin'
+
+
+def pump(src, dst, counter, index):
+    """
+    Copy fd src to fd dst until end of file, with splice when one of them is a pipe,
+    counting bytes in counter[index].
+    """
+    splice = getattr(os, 'splice', None)
+    try:
+        while True:
+            n = 0
+            if splice is not None:
+                try:
+                    n = splice(src, dst, copy_bufsize)
+                except BrokenPipeError:
+                    raise
+                except OSError:
+                    splice = None   # neither is a pipe, or not supported by the file system
+                    continue
+            else:
+                buf = os.read(src, copy_bufsize)
+                n = len(buf)
+                view = memoryview(buf)
+                while view:
+                    view = view[os.write(dst, view):]
+            if n == 0:
+                break
+            counter[index] += n
+    except BrokenPipeError:
+        pass    # the next stage exited, its exit code tells why
+
+
+def format_meter(counter, total, elapsed, compress):
+    mb = 1024 * 1024
+    bytes_in, bytes_out = counter[0], counter[-1]
+    speed = bytes_in / elapsed / mb if elapsed > 0 else 0
+    s = '{:.1f}MB in, {:.1f}MB out, {:.1f}MB/s'.format(bytes_in / mb, bytes_out / mb, speed)
+    if bytes_in and bytes_out:
+        s += ', ratio {:.3f}'.format(bytes_out / bytes_in if compress else bytes_in / bytes_out)
+    if total and speed > 0:
+        s += ', {:.0%}, ETA {}s'.format(min(1, bytes_in / total), int(max(0, total - bytes_in) / mb / speed))
+    return s
+
+
+def run_metered(cmds, src, dst, total, args, compress, head=b''):
+    """
+    Run cmds as a pipeline, pumping the data between src, each of cmds and dst through this process,
+    to count the bytes into the first command and out of the last one.
+    src and dst are file names, '-' for stdin and stdout, or None if the command opens the files itself.
+    head is input already read from src, written to the first command before the rest of src.
+    The progress is reported to stderr with --progress, and saved to --stats-file as json.
+    """
+    import subprocess, threading, json
+    if args.verbosity:
+        print('running: ' + ' | '.join(str(x) for x in cmds), file=sys.stderr)
+    start = time.time()
+    files, procs, pumps = [], [], []
+    counter = []
+
+    def add_pump(src_file, dst_file):
+        def run(index):
+            try:
+                if index == 0 and head:
+                    write_all(dst_file.fileno(), head)
+                    counter[0] += len(head)
+                pump(src_file.fileno(), dst_file.fileno(), counter, index)
+            finally:
+                # let the next command see the end of file
+                for f in (src_file, dst_file):
+                    if f not in (sys.stdin.buffer, sys.stdout.buffer):
+                        f.close()
+
+        counter.append(0)
+        pumps.append(threading.Thread(target=run, args=(len(counter) - 1,), daemon=True))
+
+    if src is not None:
+        files.append(sys.stdin.buffer if src == '-' else open(src, 'rb'))
+    for i, cmd in enumerate(cmds):
+        first, last = i == 0, i == len(cmds) - 1
+        procs.append(cmd.popen(stdin=subprocess.PIPE if not first or src is not None else None,
+                               stdout=subprocess.PIPE if not last or dst is not None else None, stderr=None))
+        if first and src is not None:
+            add_pump(files[0], procs[0].stdin)
+        if not first:
+            add_pump(procs[-2].stdout, procs[-1].stdin)
+    if dst is not None:
+        files.append(sys.stdout.buffer if dst == '-' else open(dst, 'wb'))
+        add_pump(procs[-1].stdout, files[-1])
+
+    tty = sys.stderr.isatty()
+    for t in pumps:
+        t.start()
+    for t in pumps:
+        t.join(meter_interval if tty else meter_log_interval)
+        while t.is_alive():
+            if args.progress:
+                print(('\r' if tty else '') + format_meter(counter, total, time.time() - start, compress),
+                      end='  ' if tty else '\n', file=sys.stderr, flush=True)
+            t.join(meter_interval if tty else meter_log_interval)
+    retcodes = [p.wait() for p in procs]
+    elapsed = time.time() - start
+    ret = next((r for r in retcodes if r != 0), 0)
+
+    if args.progress:
+        print(('\r' if tty else '') + format_meter(counter, total, elapsed, compress), file=sys.stderr)
+    if args.stats_file is not None:
+        stats = {'command': ' | '.join(str(x) for x in cmds), 'bytes_in': counter[0], 'bytes_out': counter[-1],
+                 'total': total, 'seconds': round(elapsed, 3),
+                 'mb_per_s': round(counter[0] / elapsed / 1024 / 1024, 3) if elapsed > 0 else None,
+                 'ratio': None, 'retcode': ret}
+        if counter[0] and counter[-1]:
+            stats['ratio'] = round(counter[-1] / counter[0] if compress else counter[0] / counter[-1], 4)
+        with open(args.stats_file, 'w') as f:
+            json.dump(stats, f, indent=1)
+    return ret
+
+
+def metered_command_line(cmds, src, dst):
+    s = ' | '.join(str(x) for x in cmds)
+    if src is not None:
+        s += ' < ' + src
+    if dst is not None:
+        s += ' > ' + dst
+    return s
+
+
+def run_metered_dry(cmds, src, dst, total, args, compress, head=b''):
+    print(metered_command_line(cmds, src, dst))
+    return 0
+## end meter*
+
+
+## begin stdin*
+class StreamReader:
+    """
+    Sequential reader of fd that can give back what it has read,
+    the bytes peeked to identify stdin are replayed this way.
+    """
+
+    def __init__(self, fd, head=b''):
+        self.fd = fd
+        self.buf = bytearray(head)
+        self.peeked = bytearray()
+        self.peeking = False
+
+    def read(self, n=-1):
+        data = bytearray()
+        while n < 0 or len(data) < n:
+            if self.buf:
+                size = len(self.buf) if n < 0 else n - len(data)
+                chunk = bytes(self.buf[:size])
+                del self.buf[:size]
+            else:
+                chunk = os.read(self.fd, copy_bufsize if n < 0 else min(n - len(data), copy_bufsize))
+                if not chunk:
+                    break
+            data += chunk
+        if self.peeking:
+            self.peeked += data
+        return bytes(data)
+
+    def unread(self, data):
+        self.buf[:0] = data
+
+    def drain(self):
+        self.buf.clear()
+        while os.read(self.fd, copy_bufsize):
+            pass
+
+
+def identify_stdin(reader):
+    """
+    Identify format by the head of a pipe, and put the head back into reader.
+    """
+    reader.peeking = True
+    try:
+        fmt = sniff(reader)
+    finally:
+        reader.peeking = False
+        reader.unread(reader.peeked)
+        reader.peeked = bytearray()
+    return fmt
+
+
+def stdin_head(args):
+    reader = getattr(args, 'stdin_reader', None)
+    return bytes(reader.buf) if reader is not None else b''
+
+
+def write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def run_replay(cmd, reader, verbose=False):
+    """
+    Run cmd with the peeked head of stdin and then the rest of it, spliced without copying, as input.
+    """
+    import subprocess
+    if verbose:
+        print('running: ' + str(cmd), file=sys.stderr)
+    proc = cmd.popen(stdin=subprocess.PIPE, stdout=None, stderr=None)
+    procs = [proc]
+    while getattr(procs[0], 'srcproc', None) is not None:
+        procs.insert(0, procs[0].srcproc)
+    stdin = procs[0].stdin
+    try:
+        write_all(stdin.fileno(), reader.buf)
+        reader.buf.clear()
+        pump(reader.fd, stdin.fileno(), [0], 0)
+    except BrokenPipeError:
+        pass    # the command exited, its exit code tells why
+    finally:
+        stdin.close()
+    retcodes = [p.wait() for p in procs]
+    return next((r for r in retcodes if r != 0), 0)
+
+
+def run_replay_dry(cmd, reader, verbose=False):
+    print(str(cmd) + ' < -')
+    return 0
+
+
+zip_local_header = '<4s5H3L2H'     # up to the name and extra field lengths
+
+
+def zip_stream_decompressor(method):
+    if method == 8:
+        import zlib
+        return zlib.decompressobj(-15)
+    elif method == 12:
+        import bz2
+        return bz2.BZ2Decompressor()
+    raise Exception('unsupported compression method {} in zip from stdin'.format(method))
+
+
+def iter_zip_stream(f):
+    """
+    Members of a zip read sequentially from the local headers, without the central directory at the end.
+    Yield (ZipInfo, chunks), chunks must be consumed before the next member.
+    Unix modes are only in the central directory, they are not restored.
+    """
+    import zipfile, zlib, struct
+    header_size = struct.calcsize(zip_local_header)
+    while True:
+        header = f.read(header_size)
+        if len(header) < 4 or header[:4] in {b'PK\x01\x02', b'PK\x05\x06', b'PK\x06\x06'}:
+            return
+        if len(header) < header_size or header[:4] != b'PK\x03\x04':
+            raise Exception('bad zip local header')
+        _, _, flags, method, dos_time, dos_date, crc, csize, usize, name_len, extra_len = \
+            struct.unpack(zip_local_header, header)
+        name = f.read(name_len).decode('utf-8' if flags & 0x800 else 'cp437')
+        extra = f.read(extra_len)
+        if flags & 0x1:
+            raise Exception('encrypted zip can not be extracted from stdin')
+
+        zip64 = False
+        pos = 0
+        while pos + 4 <= len(extra):
+            tag, size = struct.unpack_from('<HH', extra, pos)
+            if tag == 0x0001:
+                zip64 = True
+                values = iter(struct.unpack_from('<%dQ' % (size // 8), extra, pos + 4))
+                if usize == 0xFFFFFFFF:
+                    usize = next(values)
+                if csize == 0xFFFFFFFF:
+                    csize = next(values)
+            pos += 4 + size
+
+        info = zipfile.ZipInfo(name, ((dos_date >> 9) + 1980, (dos_date >> 5) & 0xF, dos_date & 0x1F,
+                                      dos_time >> 11, (dos_time >> 5) & 0x3F, (dos_time & 0x1F) * 2))
+        info.compress_type = method
+        info.flag_bits = flags
+
+        def chunks(crc=crc, csize=csize):
+            descriptor = flags & 0x8
+            if method == 0:
+                if descriptor:
+                    raise Exception('stored member with data descriptor in zip from stdin: ' + name)
+                d = None
+            else:
+                d = zip_stream_decompressor(method)
+            value = 0
+            remain = csize
+            while (descriptor and not d.eof) or (not descriptor and remain > 0):
+                data = f.read(copy_bufsize if descriptor else min(remain, copy_bufsize))
+                if not data:
+                    raise Exception('unexpected end of zip from stdin: ' + name)
+                remain -= len(data)
+                if d is not None:
+                    data = d.decompress(data)
+                    if descriptor and d.eof:
+                        f.unread(d.unused_data)
+                value = zlib.crc32(data, value)
+                yield data
+            if descriptor:
+                sig = f.read(4)
+                if sig != b'PK\x07\x08':
+                    f.unread(sig)
+                crc = struct.unpack('<L', f.read(4))[0]
+                f.read(16 if zip64 else 8)
+            if value != crc:
+                raise Exception('bad CRC in zip from stdin: ' + name)
+
+        yield info, chunks()
+
+
+def unpack_zip_stream(args, reader):
+    args.output = ensure_output_dir(args.output)
+
+    def unpack_zip_stream_builtin():
+        dirs = []
+        for info, chunks in iter_zip_stream(reader):
+            wanted = not args.member or match_member(info.filename, args.member)
+            path = zip_target_path(info, args.output)
+            if wanted and args.verbosity:
+                print(info.filename)
+            if not wanted:
+                for _ in chunks:
+                    pass
+                continue
+            if info.is_dir():
+                os.makedirs(path, exist_ok=True)
+                dirs.append((path, info))
+                for _ in chunks:
+                    pass
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as dst:
+                for data in chunks:
+                    dst.write(data)
+            mtime = time.mktime(info.date_time + (0, 0, -1))
+            os.utime(path, (mtime, mtime))
+        for path, info in sorted(dirs, reverse=True):
+            mtime = time.mktime(info.date_time + (0, 0, -1))
+            os.utime(path, (mtime, mtime))
+        reader.drain()
+
+    return run_builtin('unzip -', unpack_zip_stream_builtin, args.verbosity)
+
+
+def spool_stdin(args, reader, fmt):
+    """
+    7z and rar need to seek, save stdin to a temporary file next to the output and extract that.
+    """
+    import tempfile
+    directory = ensure_output_dir(args.output)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.packer-stdin.', suffix='' if fmt == 'unknown' else '.' + fmt)
+    try:
+        try:
+            write_all(fd, reader.buf)
+            reader.buf.clear()
+            pump(reader.fd, fd, [0], 0)
+        finally:
+            os.close(fd)
+        args.archive = tmp
+        args.format = None if fmt == 'unknown' else fmt
+        args.no_cache = True
+        return unpack(args)
+    finally:
+        os.remove(tmp)
+
+
+def unpack_stdin(args):
+    reader = StreamReader(sys.stdin.fileno())
+    fmt = args.format
+    if fmt is None:
+        fmt = identify_stdin(reader) or 'unknown'
+        if fmt != 'unknown':
+            args.format = fmt
+    fmt = format_normalize(fmt)
+    args.stdin_reader = reader
+
+    if fmt in tar_type:
+        return unpack_tar(args)
+    elif fmt in filter_type:
+        if args.member:
+            raise Exception("'%s' has no members" % fmt)
+        if args.output is None:
+            raise Exception('you must specify --to option')
+        return unpack_filter(args)
+    elif fmt == 'zip':
+        return unpack_zip_stream(args, reader)
+    return spool_stdin(args, reader, fmt)
+## end stdin*
+
+
+## begin timings*
+class Tracer:
+    """
+    Phases and commands of one run, saved as Chrome trace events (chrome://tracing, Perfetto).
+    """
+
+    def __init__(self, origin):
+        self.origin = origin
+        self.events = []
+
+    def now(self):
+        return (time.perf_counter() - self.origin) * 1e6    # microseconds
+
+    def add(self, name, cat, start, end, args=None):
+        import threading
+        self.events.append({'name': name, 'cat': cat, 'ph': 'X', 'ts': round(start, 1),
+                            'dur': round(end - start, 1), 'pid': os.getpid(),
+                            'tid': threading.get_ident(), 'args': args or {}})
+
+    def phase(self, func, name, cat='phase'):
+        def traced(*args, **kwds):
+            start = self.now()
+            try:
+                return func(*args, **kwds)
+            finally:
+                self.add(name, cat, start, self.now())
+        return traced
+
+    def save(self, filename):
+        import json
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
+
+    def print_summary(self, file=sys.stderr):
+        for e in sorted(self.events, key=lambda e: e['ts']):
+            usage = ''
+            if 'utime' in e['args']:
+                usage = ' user {utime:.3f}s sys {stime:.3f}s maxrss {maxrss}K exit {exit}'.format(**e['args'])
+            print('{:9.1f}ms {:9.1f}ms  {:8} {}{}'.format(
+                e['ts'] / 1000, e['dur'] / 1000, e['cat'], e['name'], usage), file=file)
+
+
+tracer = None
+
+
+class TracedLocalCommands(LocalCommands):
+    """
+    Record each command lookup, so the cost of probing fallback packers shows up.
+    """
+    def __getitem__(self, name):
+        start = tracer.now()
+        found = False
+        try:
+            cmd = LocalCommands.__getitem__(self, name)
+            found = True
+            return cmd
+        finally:
+            tracer.add('lookup ' + str(name), 'lookup', start, tracer.now(), {'found': found})
+
+
+def run_cmd_traced(cmd, verbose=False):
+    """
+    run_cmd that waits for each process of the pipeline with wait4, to record its cpu time.
+    """
+    if verbose:
+        print('running: ' + str(cmd), file=sys.stderr)
+    start = tracer.now()
+    proc = cmd.popen(stdin=None, stdout=None, stderr=None)
+    procs = [proc]
+    while getattr(procs[0], 'srcproc', None) is not None:
+        procs.insert(0, procs[0].srcproc)
+    ret = 0
+    for p in procs:
+        _, status, usage = os.wait4(p.pid, 0)
+        code = os.waitstatus_to_exitcode(status)
+        getattr(p, '_proc', p).returncode = code
+        ret = ret or code
+        tracer.add(' '.join(getattr(p, 'argv', [str(p.pid)])), 'command', start, tracer.now(),
+                   {'utime': usage.ru_utime, 'stime': usage.ru_stime, 'maxrss': usage.ru_maxrss, 'exit': code})
+    return ret
+
+
+def timings_patch(origin):
+    global tracer, local, run_cmd
+    tracer = Tracer(origin)
+    local = TracedLocalCommands()
+    if run_cmd is not run_cmd_dry:
+        run_cmd = run_cmd_traced
+    for name in ('identify', 'identify_by_file', 'ensure_output_dir', 'pack', 'unpack', 'view',
+                 'run_builtin', 'run_records', 'run_metered'):
+        globals()[name] = tracer.phase(globals()[name], name)
+    return tracer
+## end timings*
+
+
+## begin tools*
+# (feature, options to print help, text in the help meaning the feature is supported)
+tool_features = {
+    'tar' : (('zstd', ['--help'], '--zstd'), ('lzip', ['--help'], '--lzip'), ('wildcards', ['--help'], '--wildcards')),
+    'xz'  : (('threads', ['--long-help'], '--threads'),),
+    'zstd': (('long', ['-H'], '--long'), ('threads', ['-H'], '-T#'), ('train', ['-H'], '--train')),
+}
+# (feature, minimum version)
+tool_versions = {
+    'xz'  : (('parallel_decode', (5, 4)),),
+}
+
+
+def parse_version(s):
+    import re
+    m = re.search(r'(\d+)\.(\d+)(?:\.(\d+))?', s or '')
+    return tuple(int(x) for x in m.groups() if x is not None) if m else None
+
+
+def probe_features(name, path):
+    import subprocess
+    features = []
+    helps = {}
+    for feature, opt, text in tool_features.get(name, ()):
+        key = tuple(opt)
+        if key not in helps:
+            try:
+                helps[key] = subprocess.run([path] + opt, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                            stderr=subprocess.STDOUT, timeout=10).stdout.decode('utf-8', 'replace')
+            except (OSError, subprocess.TimeoutExpired):
+                helps[key] = ''
+        if text in helps[key]:
+            features.append(feature)
+    return features
+
+
+class ToolRegistry:
+    """
+    Where tools are installed, their versions and features, probed once and cached in tools.json.
+    Presence is probed again when PATH or the mtime of a directory in PATH changes,
+    version and features when the mtime of the tool changes.
+    Safe to use from several threads, as the server and the async API do.
+    """
+
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(get_cache_dir(), 'tools.json')
+        self.path = path
+        self.data = None
+
+    @property
+    def lock(self):
+        # threading is imported on first use only, setdefault keeps one lock if threads race here
+        lock = self.__dict__.get('_lock')
+        if lock is None:
+            import threading
+            lock = self.__dict__.setdefault('_lock', threading.RLock())
+        return lock
+
+    @staticmethod
+    def state():
+        path_env = os.environ.get('PATH', os.defpath)
+        dirs = {}
+        for d in path_env.split(os.pathsep):
+            try:
+                dirs[d] = os.stat(d or os.curdir).st_mtime_ns
+            except OSError:
+                dirs[d] = None
+        return path_env, dirs
+
+    def load(self):
+        with self.lock:
+            if self.data is None:
+                import json
+                try:
+                    with open(self.path) as f:
+                        data = json.load(f)
+                except (OSError, ValueError):
+                    data = {}
+                path_env, dirs = self.state()
+                if not isinstance(data, dict) or data.get('path') != path_env or data.get('dirs') != dirs:
+                    # a tool may have been installed or removed
+                    data = {'path': path_env, 'dirs': dirs, 'tools': {}}
+                self.data = data
+            return self.data
+
+    def save(self):
+        import json, tempfile
+        with self.lock:
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix='.tools.')
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(self.data, f, indent=1)
+                os.replace(tmp, self.path)
+            except OSError:
+                pass    # cache is optional
+
+    def which(self, name):
+        with self.lock:
+            tools = self.load()['tools']
+            if name not in tools:
+                import shutil
+                tools[name] = {'path': shutil.which(name)}
+                self.save()
+            return tools[name]['path']
+
+    def info(self, name, refresh=False):
+        """
+        Return dict of path, version and features of tool name, None if it is not installed.
+        """
+        with self.lock:
+            path = self.which(name)
+            if path is None:
+                return None
+            entry = self.data['tools'][name]
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except OSError:
+                del self.data['tools'][name]
+                return None
+            if refresh or entry.get('mtime') != mtime:
+                entry['mtime'] = mtime
+                entry['version'] = get_tool_version(path)
+                entry['features'] = probe_features(name, path)
+                version = parse_version(entry['version'])
+                for feature, minimum in tool_versions.get(name, ()):
+                    if version is not None and version >= minimum:
+                        entry['features'].append(feature)
+                self.save()
+            return entry
+
+    def has(self, name, feature):
+        entry = self.info(name)
+        return entry is not None and feature in entry['features']
+
+
+tool_registry = ToolRegistry()
+
+
+def known_tools():
+    tools = {'tar', 'zip', 'unzip', '7z', '7zr', 'rar', 'unrar', 'winrar', 'file'}
+    tools.update(suf2filter.values())
+    for table in (suf2parallel_filter, suf2parallel_decompressor):
+        for candidates in table.values():
+            tools.update(x[0] for x in candidates)
+    return sorted(tools)
+
+
+def print_tools(args):
+    for name in known_tools():
+        entry = tool_registry.info(name, refresh=args.no_cache)
+        if entry is None:
+            print('{:8} not found'.format(name))
+        else:
+            print('{:8} {}\n         {}{}'.format(name, entry['path'], entry['version'] or 'unknown version',
+                                                 ''.join('\n         +' + x for x in entry['features'])))
+    return 0
+## end tools*
+
+
+## begin serve*
+serve_poll_interval = 0.1   # seconds between checks of the worker and the client
+serve_max_request = 16 * 1024 * 1024
+
+
+def send_frame(sock, data, fds=()):
+    import socket, struct
+    msg = struct.pack('<L', len(data)) + data
+    if fds:
+        socket.send_fds(sock, [msg[:1]], list(fds))
+        msg = msg[1:]
+    sock.sendall(msg)
+
+
+def recv_exact(sock, n):
+    data = bytearray()
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            raise EOFError('connection closed')
+        data += chunk
+    return bytes(data)
+
+
+def recv_frame(sock, nfds=0):
+    import socket, struct
+    fds = []
+    head = b''
+    if nfds:
+        head, fds, _, _ = socket.recv_fds(sock, 1, nfds)
+        if not head:
+            raise EOFError('connection closed')
+    head += recv_exact(sock, 4 - len(head))
+    size = struct.unpack('<L', head)[0]
+    if size > serve_max_request:
+        raise Exception('request too large')
+    return recv_exact(sock, size), fds
+
+
+def client_gone(sock):
+    import select, socket
+    readable, _, _ = select.select([sock], [], [], 0)
+    return bool(readable) and not sock.recv(1, socket.MSG_PEEK)
+
+
+def serve_warm_up():
+    """
+    Pay once for what each run would pay: imports and tool lookups.
+    """
+    import plumbum, tarfile, zipfile, gzip, bz2, lzma, json, subprocess, threading, concurrent.futures
+    from plumbum import FG, ProcessExecutionError
+    for name in known_tools():
+        tool_registry.which(name)
+
+
+def serve_child(request, fds):
+    """
+    Run one request in the forked worker, with stdin, stdout and stderr of the client.
+    """
+    import signal
+    code = 1
+    try:
+        os.setpgid(0, 0)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        for i, fd in enumerate(fds[:3]):
+            os.dup2(fd, i)
+        # drop what was inherited from the server: the listener, connections and fds of other clients
+        os.closerange(3, os.sysconf('SC_OPEN_MAX'))
+        os.chdir(request['cwd'])
+        os.environ.clear()
+        os.environ.update(request['env'])
+        if tool_registry.data is not None and tool_registry.data.get('path') != os.environ.get('PATH', os.defpath):
+            tool_registry.data = None
+        code = run_argv(request['app'], request['argv'], time.perf_counter())
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else 1
+    except BaseException:
+        import traceback
+        traceback.print_exc()
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(code & 0xFF)
+
+
+def serve_client(conn, slots, fork_lock, verbose):
+    """
+    Queue a request for a free slot, fork a worker for it, and kill the worker if the client goes away.
+    Forks are serialized by fork_lock, the server is multi-threaded.
+    """
+    import json, signal, select
+    with conn:
+        try:
+            data, fds = recv_frame(conn, 3)
+            request = json.loads(data)
+        except Exception as e:
+            if verbose:
+                print('bad request: {}'.format(e), file=sys.stderr)
+            return
+        try:
+            while not slots.acquire(timeout=serve_poll_interval):
+                if client_gone(conn):
+                    return
+            pidfd = None
+            try:
+                if verbose:
+                    print('running: {}'.format(' '.join(request['argv'])), file=sys.stderr)
+                with fork_lock:
+                    sys.stdout.flush()
+                    sys.stderr.flush()
+                    pid = os.fork()
+                    if pid == 0:
+                        serve_child(request, fds)
+                    # the worker has them now, do not leak them into workers of other clients
+                    for fd in fds:
+                        os.close(fd)
+                    fds = []
+                code = None
+                if hasattr(os, 'pidfd_open'):
+                    pidfd = os.pidfd_open(pid)
+                while code is None:
+                    done, status = os.waitpid(pid, os.WNOHANG)
+                    if done:
+                        code = os.waitstatus_to_exitcode(status)
+                    elif client_gone(conn):
+                        # cancelled, take down the commands the worker started too
+                        try:
+                            os.killpg(pid, signal.SIGTERM)
+                        except OSError:
+                            os.kill(pid, signal.SIGTERM)
+                        code = os.waitstatus_to_exitcode(os.waitpid(pid, 0)[1])
+                        if verbose:
+                            print('cancelled: {}'.format(' '.join(request['argv'])), file=sys.stderr)
+                        return
+                    elif pidfd is not None:
+                        # wake up when either the worker exits or the client sends or closes
+                        select.select([conn, pidfd], [], [])
+                    else:
+                        time.sleep(serve_poll_interval)
+            finally:
+                if pidfd is not None:
+                    os.close(pidfd)
+                slots.release()
+        finally:
+            for fd in fds:
+                os.close(fd)
+        if code < 0:
+            code = 128 - code    # killed by signal, like the shell
+        try:
+            send_frame(conn, json.dumps({'exit': code}).encode())
+        except OSError:
+            pass
+
+
+def serve(args):
+    """
+    Run requests of clients on the unix socket args.socket, at most args.jobs at a time.
+    """
+    import socket, threading, signal
+    serve_warm_up()
+    path = args.socket
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except OSError:
+            os.remove(path)     # stale socket of a dead server
+        else:
+            raise Exception('{} is in use by another server'.format(path))
+        finally:
+            probe.close()
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o177)
+    try:
+        listener.bind(path)
+    finally:
+        os.umask(old_umask)
+    listener.listen(128)
+    slots = threading.BoundedSemaphore(max(1, args.jobs))
+    fork_lock = threading.Lock()
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, stop)
+    print('serving on {} with {} jobs'.format(path, max(1, args.jobs)), file=sys.stderr, flush=True)
+    try:
+        while True:
+            conn, _ = listener.accept()
+            threading.Thread(target=serve_client, args=(conn, slots, fork_lock, args.verbosity),
+                             daemon=True).start()
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        listener.close()
+        os.remove(path)
+
+
+def run_client(path, app, argv_body):
+    """
+    Run argv_body in the server at path, with stdin, stdout and stderr passed to it.
+    Return None if there is no server.
+    """
+    import socket, json
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+    with sock:
+        request = {'app': app, 'argv': argv_body, 'cwd': os.getcwd(), 'env': dict(os.environ)}
+        send_frame(sock, json.dumps(request).encode(), [0, 1, 2])
+        try:
+            data, _ = recv_frame(sock)
+        except EOFError:
+            print('{}: server closed the connection'.format(app), file=sys.stderr)
+            return 1
+        except KeyboardInterrupt:
+            return 130  # closing the socket cancels the request
+        return json.loads(data)['exit']
+## end serve*
+
+
+## begin async*
+def flatten_cmd(cmd):
+    """
+    argv of each command of plumbum pipeline cmd, and (file, mode) its input and output are redirected to.
+    """
+    from plumbum.commands.base import Pipeline, BaseRedirection
+    if isinstance(cmd, Pipeline):
+        src_argvs, src, _ = flatten_cmd(cmd.srccmd)
+        dst_argvs, _, dst = flatten_cmd(cmd.dstcmd)
+        return src_argvs + dst_argvs, src, dst
+    if isinstance(cmd, BaseRedirection):
+        argvs, src, dst = flatten_cmd(cmd.cmd)
+        if cmd.KWARG == 'stdin':
+            src = (str(cmd.file), cmd.MODE)
+        elif cmd.KWARG == 'stdout':
+            dst = (str(cmd.file), cmd.MODE)
+        else:
+            raise Exception('unsupported redirection ' + str(cmd))
+        return argvs, src, dst
+    return [[str(x) for x in cmd.formulate()]], None, None
+
+
+def close_stdio(x):
+    if isinstance(x, int):
+        if x >= 0:
+            os.close(x)
+    elif x is not None:
+        x.close()
+
+
+def kill_procs(procs):
+    """
+    Kill the processes still running, stages of a pipeline may have exited already.
+    """
+    for p in procs:
+        if p.returncode is None:
+            try:
+                p.kill()
+            except ProcessLookupError:
+                pass
+
+
+async def run_pipeline_async(cmd, procs, capture=False):
+    """
+    Run plumbum pipeline cmd as asyncio subprocesses, connected by pipes that bypass this process.
+    The processes are added to procs while they run, so that they can be killed.
+    Return exit code, stdout if capture, and stderr of the commands.
+    """
+    import asyncio, subprocess
+    argvs, src, dst = flatten_cmd(cmd)
+    stdin = subprocess.DEVNULL if src is None else open(src[0], src[1] + 'b')
+    started = []
+    try:
+        for i, argv in enumerate(argvs):
+            if i < len(argvs) - 1:
+                read_end, stdout = os.pipe()
+            elif dst is not None:
+                read_end, stdout = None, open(dst[0], dst[1] + 'b')
+            else:
+                read_end, stdout = None, subprocess.PIPE if capture else subprocess.DEVNULL
+            try:
+                started.append(await asyncio.create_subprocess_exec(*argv, stdin=stdin, stdout=stdout,
+                                                                    stderr=subprocess.PIPE))
+            except BaseException:
+                close_stdio(read_end)
+                raise
+            finally:
+                close_stdio(stdin)
+                close_stdio(stdout)
+            procs.append(started[-1])
+            stdin = read_end
+    except BaseException:
+        kill_procs(started)
+        # reap the stages before passing on the error, CancelledError included
+        await asyncio.gather(*(p.wait() for p in started), return_exceptions=True)
+        for p in started:
+            procs.remove(p)
+        raise
+    reads = [p.stderr.read() for p in started]
+    if capture:
+        reads.append(started[-1].stdout.read())
+    outputs = await asyncio.gather(*reads)
+    retcodes = [await p.wait() for p in started]
+    for p in started:
+        procs.remove(p)
+    stderr = b''.join(outputs[:len(started)]).decode('utf-8', 'replace')
+    return next((r for r in retcodes if r != 0), 0), outputs[-1] if capture else None, stderr
+
+
+class ApiCall:
+    """
+    One call of the asyncio API, run in a worker thread.
+    Commands are run by the event loop and records are collected instead of written.
+    With dry_run, the commands are recorded with exit 0 instead of run, like --dry-run prints them.
+    """
+
+    def __init__(self, loop, dry_run=False):
+        self.loop = loop
+        self.dry_run = dry_run
+        self.procs = []
+        self.cancelled = False
+        self.result = {'exit': None, 'error': None, 'seconds': None, 'commands': [], 'stderr': '', 'records': []}
+
+    def run_dry(self, command):
+        self.result['commands'].append({'command': command, 'exit': 0, 'seconds': 0.0})
+        return 0
+
+    def run_pipeline(self, cmd, capture=False):
+        import asyncio
+        if self.cancelled:
+            raise Exception('cancelled')
+        start = time.perf_counter()
+        code, out, err = asyncio.run_coroutine_threadsafe(
+            run_pipeline_async(cmd, self.procs, capture), self.loop).result()
+        self.result['commands'].append({'command': str(cmd), 'exit': code,
+                                        'seconds': round(time.perf_counter() - start, 3)})
+        self.result['stderr'] += err
+        if self.cancelled:
+            raise Exception('cancelled')
+        return code, out
+
+    def run_cmd(self, func, cmd, verbose=False):
+        if self.dry_run:
+            return self.run_dry(str(cmd))
+        return self.run_pipeline(cmd)[0]
+
+    def run_records(self, func, cmd, parse, output_format, verbose=False):
+        if self.dry_run:
+            return self.run_dry(str(cmd))
+        code, out = self.run_pipeline(cmd, capture=True)
+        self.result['records'].extend(parse(StringIO(out.decode('utf-8', 'surrogateescape'))))
+        return code
+
+    def run_builtin(self, func, desc, builtin_func, verbose=False):
+        if self.dry_run:
+            return self.run_dry('builtin ' + desc)
+        start = time.perf_counter()
+        try:
+            builtin_func()
+            code = 0
+        except Exception as e:
+            self.result['error'] = str(e)
+            code = 1
+        self.result['commands'].append({'command': 'builtin ' + desc, 'exit': code,
+                                        'seconds': round(time.perf_counter() - start, 3)})
+        return code
+
+    def write_records(self, func, records, output_format, file=None, fields=None):
+        self.result['records'].extend(records)
+
+    def run_metered(self, func, cmds, src, dst, total, args, compress, head=b''):
+        if self.dry_run:
+            return self.run_dry(metered_command_line(cmds, src, dst))
+        return func(cmds, src, dst, total, args, compress, head)
+
+    def run_replay(self, func, cmd, reader, verbose=False):
+        if self.dry_run:
+            return self.run_dry(str(cmd) + ' < -')
+        return func(cmd, reader, verbose)
+
+    def ensure_output_dir(self, func, directory):
+        return directory if self.dry_run else func(directory)
+
+    def cancel(self):
+        self.cancelled = True
+        kill_procs(self.procs)
+
+
+api_local = None
+
+
+def api_patch():
+    """
+    Route the runners through the ApiCall of the current thread, threads without one run as usual.
+    """
+    global api_local
+    if api_local is not None:
+        return
+    import threading
+    api_local = threading.local()
+
+    def dispatch(name, func):
+        def run(*args, **kwds):
+            call = getattr(api_local, 'call', None)
+            if call is None:
+                return func(*args, **kwds)
+            return getattr(call, name)(func, *args, **kwds)
+        return run
+
+    for name in ('run_cmd', 'run_records', 'run_builtin', 'write_records', 'run_metered', 'run_replay',
+                 'ensure_output_dir'):
+        globals()[name] = dispatch(name, globals()[name])
+
+
+def api_argv(options):
+    """
+    Command line options from keyword arguments, threads=4 is --threads 4, seekable=True is --seekable.
+    """
+    argv = []
+    for key, value in options.items():
+        if value is None or value is False:
+            continue
+        opt = '--' + key.replace('_', '-')
+        if value is True:
+            argv.append(opt)
+        elif isinstance(value, (list, tuple)):
+            for x in value:
+                argv += [opt, str(x)]
+        else:
+            argv += [opt, str(value)]
+    return argv
+
+
+class AsyncPacker:
+    """
+    asyncio API, at most limit operations run at once, each in a worker thread
+    with its commands run as asyncio subprocesses.
+
+        packer = AsyncPacker(limit=4)
+        result = await packer.unpack('archive.tgz', to='dir/')
+        listing = await packer.list('archive.zip')
+
+    Results are dicts of exit, error, seconds, bytes_in, bytes_out, commands run with their
+    exit code and seconds, stderr of the commands, and records for listings.
+    With dry_run=True the commands are only recorded.
+    """
+
+    def __init__(self, limit=None):
+        import weakref
+        from concurrent.futures import ThreadPoolExecutor
+        self.limit = limit or os.cpu_count() or 1
+        self.semaphores = weakref.WeakKeyDictionary()
+        self.executor = ThreadPoolExecutor(max_workers=self.limit, thread_name_prefix='packer')
+        api_patch()
+
+    def semaphore(self, loop):
+        """
+        Semaphore of the running loop, asyncio primitives are bound to the loop they are used in,
+        and each asyncio.run() has its own.
+        """
+        import asyncio
+        semaphore = self.semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self.semaphores[loop] = asyncio.Semaphore(self.limit)
+        return semaphore
+
+    async def run(self, make_parser, run, argv):
+        import asyncio
+        parser = make_parser('packer')
+        try:
+            args = parser.parse_args(argv)
+        except ParseError:
+            raise Exception('invalid options: ' + ' '.join(argv))
+        loop = asyncio.get_running_loop()
+        async with self.semaphore(loop):
+            call = ApiCall(loop, getattr(args, 'dry_run', False))
+
+            def work():
+                api_local.call = call
+                start = time.perf_counter()
+                try:
+                    call.result['exit'] = run(parser, args)
+                except Exception as e:
+                    call.result['exit'] = 1
+                    call.result['error'] = str(e)
+                finally:
+                    api_local.call = None
+                    call.result['seconds'] = round(time.perf_counter() - start, 3)
+                return call.result
+
+            future = loop.run_in_executor(self.executor, work)
+            try:
+                result = await asyncio.shield(future)
+            except asyncio.CancelledError:
+                call.cancel()
+                await asyncio.wait([future])
+                raise
+        result['format'] = getattr(args, 'format', None)
+        return result
+
+    async def pack(self, inputs, to=None, fmt=None, **options):
+        inputs = [inputs] if isinstance(inputs, str) else list(inputs)
+        argv = inputs + api_argv({'to': to, 'format': fmt}) + api_argv(options)
+        result = await self.run(make_pack_parser, run_pack, argv)
+        result['bytes_in'] = get_inputs_size(inputs)
+        result['bytes_out'] = get_file_size(to) if to is not None else None
+        return result
+
+    async def unpack(self, archive, to=None, fmt=None, **options):
+        argv = ['-x', archive] + api_argv({'to': to, 'format': fmt}) + api_argv(options)
+        result = await self.run(make_unpack_parser, run_unpack, argv)
+        result['bytes_in'] = get_file_size(archive)
+        result['bytes_out'] = get_file_size(to) if to is not None and os.path.isfile(to) else None
+        return result
+
+    async def list(self, archive, fmt=None, test=False, **options):
+        """
+        List archive as records of record_fields, with test=True test it and return one record of test_fields.
+        """
+        argv = ['--list', archive, '--format-output', 'jsonl'] + api_argv({'format': fmt, 'test': test})
+        result = await self.run(make_view_parser, run_view, argv + api_argv(options))
+        result['bytes_in'] = get_file_size(archive)
+        result['bytes_out'] = None
+        return result
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+default_async_packer = None
+
+
+def get_async_packer():
+    global default_async_packer
+    if default_async_packer is None:
+        default_async_packer = AsyncPacker()
+    return default_async_packer
+
+
+async def pack_async(inputs, to=None, fmt=None, **options):
+    return await get_async_packer().pack(inputs, to, fmt, **options)
+
+
+async def unpack_async(archive, to=None, fmt=None, **options):
+    return await get_async_packer().unpack(archive, to, fmt, **options)
+
+
+async def list_async(archive, fmt=None, test=False, **options):
+    return await get_async_packer().list(archive, fmt, test, **options)
+## end async*
+
+
+## begin benchmark*
+bench_formats = ('tar', 'tar.gz', 'tar.bz2', 'tar.xz', 'tar.zst', 'tar.lz4', 'zip', '7z')
+bench_tolerance = 0.1   # relative change reported as regression by --compare
+
+
+def generate_corpus(directory, size, seed=0):
+    """
+    Generate a reproducible corpus of about size bytes in directory:
+    text, binaries, already compressed media, many tiny files and one huge file.
+    """
+    import random, struct
+    rng = random.Random(seed)
+    words = [''.join(rng.choice('etaoinshrdlucmfwypvbgkjqxz') for _ in range(rng.randint(1, 10)))
+             for _ in range(5000)]
+
+    def text(n):
+        out = []
+        total = 0
+        while total < n:
+            line = ' '.join(rng.choice(words) for _ in range(rng.randint(3, 15))) + '\n'
+            out.append(line)
+            total += len(line)
+        return ''.join(out).encode()[:n]
+
+    def binary(n):
+        # structured records with small deltas, random padding, like object files and databases
+        out = bytearray()
+        value = 0
+        while len(out) < n:
+            value += rng.randint(0, 300)
+            out += struct.pack('<IIH', value, rng.randint(0, 15), rng.getrandbits(16))
+            if rng.random() < 0.05:
+                out += bytes(rng.randint(0, 64))
+        return bytes(out[:n])
+
+    def noise(n):
+        return rng.getrandbits(n * 8).to_bytes(n, 'little') if n else b''
+
+    def write(path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    for i in range(8):
+        write(os.path.join(directory, 'text', 'doc{}.txt'.format(i)), text(size // 5 // 8))
+    for i in range(4):
+        write(os.path.join(directory, 'binary', 'obj{}.bin'.format(i)), binary(size // 5 // 4))
+    for i in range(2):
+        write(os.path.join(directory, 'media', 'clip{}.dat'.format(i)), noise(size // 10 // 2))
+    tiny = max(1, size // 10 // 500)
+    for i in range(tiny):
+        write(os.path.join(directory, 'tiny', str(i % 16), 'f{}.txt'.format(i)), text(rng.randint(10, 900)))
+    huge = size * 2 // 5
+    write(os.path.join(directory, 'huge', 'huge.dat'), text(huge // 2) + binary(huge // 4) + noise(huge // 4))
+
+
+def bench_packers(fmt):
+    """
+    Packers to benchmark for fmt, with the tools they need.
+    """
+    if fmt in tar_type:
+        packers = [('tar', ['tar'] + ([get_filter_name(fmt)] if fmt != 'tar' else []))]
+        if fmt in builtin_tar_type:
+            packers.append(('builtin', []))
+    elif fmt == 'zip':
+        packers = [('zip', ['zip', 'unzip']), ('7z', ['7z']), ('builtin', [])]
+    elif fmt == '7z':
+        packers = [('7z', ['7z']), ('7zr', ['7zr'])]
+    else:
+        packers = [('rar', ['rar'])]
+    return [packer for packer, tools in packers if all(tool_registry.which(x) for x in tools)]
+
+
+def get_filter_name(fmt):
+    suf = fmt.split('.')[-1]
+    return suf2filter[suf] if suf != 'Z' else 'gzip'
+
+
+def measure_cmd(argv, cwd):
+    """
+    Run argv, return (exit code, wall time, cpu time, peak rss in KiB) of it and its children.
+    """
+    import subprocess
+    start = time.perf_counter()
+    proc = subprocess.Popen(argv, cwd=cwd, stdout=subprocess.DEVNULL)
+    _, status, usage = os.wait4(proc.pid, 0)
+    wall = time.perf_counter() - start
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return proc.returncode, wall, usage.ru_utime + usage.ru_stime, usage.ru_maxrss
+
+
+def benchmark(args):
+    import json, platform, shutil, tempfile
+    formats = args.formats.split(',') if args.formats else bench_formats
+    levels = [int(x) for x in args.levels.split(',')] if args.levels else [None]
+    packer_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'packer.py')
+
+    tmp = tempfile.mkdtemp(prefix='packer-bench-')
+    try:
+        corpus = args.corpus
+        if corpus is None:
+            corpus = os.path.join(tmp, 'corpus')
+            print('generating {}M corpus'.format(args.corpus_size), file=sys.stderr)
+            generate_corpus(corpus, args.corpus_size * 1024 * 1024, args.seed)
+        corpus = os.path.abspath(corpus)
+        cwd = os.path.dirname(corpus)
+        inputs = [os.path.basename(corpus)]
+        input_bytes = get_inputs_size([corpus])
+
+        results = []
+        for fmt in formats:
+            fmt = format_normalize(fmt)
+            for packer in bench_packers(fmt):
+                for level in levels:
+                    archive = os.path.join(tmp, 'archive.' + fmt)
+                    out = os.path.join(tmp, 'out')
+                    common = ['--packer', packer, '--format', fmt, '--no-cache']
+                    ops = [
+                        ('pack', inputs + ['--to', archive] + common +
+                         (['--level', str(level)] if level is not None else [])),
+                        ('unpack', ['-x', archive, '--to', out] + common),
+                        ('list', ['--list', archive] + common),
+                    ]
+                    archive_bytes = None
+                    for op, argv in ops:
+                        # best of --repeat runs
+                        runs = [measure_cmd([sys.executable, packer_py] + argv, cwd)
+                                for _ in range(max(1, args.repeat))]
+                        code = max(r[0] for r in runs)
+                        _, wall, cpu, rss = min(runs, key=lambda r: r[1])
+                        if op == 'pack':
+                            archive_bytes = get_file_size(archive)
+                        rec = {'format': fmt, 'packer': packer, 'level': level, 'op': op,
+                               'exit_code': code, 'wall': round(wall, 4), 'cpu': round(cpu, 4),
+                               'max_rss_kb': rss, 'input_bytes': input_bytes,
+                               'archive_bytes': archive_bytes,
+                               'ratio': round(archive_bytes / input_bytes, 4) if input_bytes else None,
+                               'throughput_mb_s': round(input_bytes / wall / 1e6, 2) if wall else None}
+                        results.append(rec)
+                        print('{format:8} {packer:8} {level!s:5} {op:7} {wall:8.3f}s cpu {cpu:8.3f}s '
+                              'rss {max_rss_kb:7}K ratio {ratio!s:7} {throughput_mb_s!s:>8}MB/s'.format(**rec))
+                    for path in (archive, out):
+                        if os.path.isdir(path):
+                            shutil.rmtree(path)
+                        elif os.path.exists(path):
+                            os.remove(path)
+    finally:
+        shutil.rmtree(tmp)
+
+    report = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'host': platform.node(),
+              'python': platform.python_version(), 'corpus': args.corpus, 'corpus_size': args.corpus_size,
+              'seed': args.seed, 'tools': bench_tool_versions(formats), 'results': results}
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+
+    ret = 1 if any(r['exit_code'] != 0 for r in results) else 0
+    if args.compare is not None:
+        with open(args.compare) as f:
+            old = json.load(f)
+        if compare_benchmark(old, report):
+            ret = 1
+    return ret
+
+
+def bench_tool_versions(formats):
+    tools = {'tar', 'zip', 'unzip', '7z', '7zr', 'rar'}
+    tools.update(get_filter_name(fmt) for fmt in formats if format_normalize(fmt) in tar_type - {'tar'})
+    versions = {}
+    for tool in sorted(tools):
+        entry = tool_registry.info(tool)
+        if entry is not None:
+            versions[tool] = entry['version']
+    return versions
+
+
+def get_tool_version(tool):
+    import subprocess
+    for opt in (['--version'], ['-V'], []):
+        try:
+            out = subprocess.run([tool] + opt, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT, timeout=10).stdout
+        except (OSError, subprocess.TimeoutExpired):
+            return None
+        import re
+        for line in out.decode('utf-8', 'replace').splitlines():
+            if re.search(r'\d+\.\d+', line):
+                return line.strip()
+    return None
+
+
+def compare_benchmark(old, new):
+    """
+    Print changes of new results against old, return True if there is any regression.
+    """
+    def key(r):
+        return r['format'], r['packer'], r['level'], r['op']
+
+    old_results = {key(r): r for r in old['results']}
+    regressed = False
+    for tool, version in new['tools'].items():
+        if old.get('tools', {}).get(tool) != version:
+            print('tool changed: {}: {} -> {}'.format(tool, old.get('tools', {}).get(tool), version))
+    for r in new['results']:
+        o = old_results.get(key(r))
+        if o is None:
+            continue
+        for field in ('wall', 'cpu', 'ratio', 'max_rss_kb'):
+            if not o.get(field) or r.get(field) is None:
+                continue
+            change = (r[field] - o[field]) / o[field]
+            if change > bench_tolerance:
+                regressed = True
+                print('regression: {} {} {} {}: {} {} -> {} (+{:.0%})'.format(
+                    r['format'], r['packer'], r['level'], r['op'], field, o[field], r[field], change))
+    return regressed
+## end benchmark*
+
+
+## begin profile*
+# (filter, level) tried on a sample of the inputs, from fast to slow
+profile_candidates = (
+    ('lz4', 1), ('zst', 1), ('gz', 1), ('zst', 3), ('gz', 6), ('zst', 9), ('bz2', 9),
+    ('xz', 1), ('xz', 6), ('zst', 19), ('xz', 9),
+)
+# minimum throughput in MB/s of each profile, the best ratio that meets it wins
+profile_throughput = {
+    'fast': None,       # highest throughput
+    'balanced': 20,
+    'best': 0,
+}
+sample_size = 4 * 1024 * 1024
+sample_chunk = 256 * 1024
+
+
+def parse_throughput(s):
+    """
+    Parse throughput like '200MB/s', '1.5G', '800K' to MB/s.
+    """
+    import re
+    m = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMG]?)(?:i?B)?(?:/s)?\s*$', s, re.IGNORECASE)
+    if m is None:
+        raise ValueError('bad throughput ' + s)
+    return float(m.group(1)) * {'K': 1 / 1024, '': 1, 'M': 1, 'G': 1024}[m.group(2).upper()]
+
+
+def read_sample(inputs):
+    """
+    Read up to sample_size bytes from the beginning of files under inputs, spread over many files.
+    """
+    paths = []
+    for x in inputs:
+        if os.path.isdir(x):
+            for root, dirs, files in os.walk(x):
+                paths += [os.path.join(root, name) for name in sorted(files)]
+        elif x != '-':
+            paths.append(x)
+    sample = []
+    total = 0
+    for i, path in enumerate(paths):
+        if total >= sample_size:
+            break
+        # at least sample_chunk from each file, more if there are few files
+        chunk = max(sample_chunk, (sample_size - total) // (len(paths) - i))
+        try:
+            with open(path, 'rb') as f:
+                data = f.read(min(chunk, sample_size - total))
+        except OSError:
+            continue
+        sample.append(data)
+        total += len(data)
+    return b''.join(sample)
+
+
+def compress_sample(suf, level, data):
+    if suf == 'gz':
+        import zlib
+        return zlib.compress(data, level)
+    elif suf == 'bz2':
+        import bz2
+        return bz2.compress(data, level)
+    elif suf == 'xz':
+        import lzma
+        return lzma.compress(data, preset=level)
+    else:
+        import subprocess
+        return subprocess.run([suf2filter[suf], '-{}'.format(level), '-c'], input=data,
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout
+
+
+def parallel_available(suf):
+    return any(tool_registry.which(cmd_bin) for cmd_bin, _ in suf2parallel_filter.get(suf, ()))
+
+
+def choose_codec(args, sufs=None):
+    """
+    Try candidates on a sample of args.inputs within args.sample_time seconds,
+    return (filter, level) of the best candidate for the profile.
+    """
+    if args.min_throughput is not None:
+        target = parse_throughput(args.min_throughput)
+    else:
+        target = profile_throughput[args.profile]
+
+    data = read_sample(args.inputs)
+    if not data:
+        return None
+    deadline = time.time() + args.sample_time
+    results = []
+    for suf, level in profile_candidates:
+        if sufs is not None and suf not in sufs:
+            continue
+        if suf not in {'gz', 'bz2', 'xz'} and tool_registry.which(suf2filter[suf]) is None:
+            continue
+        start = time.perf_counter()
+        try:
+            size = len(compress_sample(suf, level, data))
+        except Exception:
+            continue
+        elapsed = max(time.perf_counter() - start, 1e-6)
+        speed = len(data) / elapsed / 1024 / 1024
+        if parallel_available(suf):
+            speed *= max(1, args.threads)
+        results.append((suf, level, size / len(data), speed))
+        if args.verbosity > 1:
+            print('sample {} -{}: ratio {:.3f}, {:.1f}MB/s'.format(suf, level, size / len(data), speed),
+                  file=sys.stderr)
+        if time.time() > deadline:
+            break
+    if not results:
+        return None
+
+    if target is None:
+        suf, level, ratio, speed = max(results, key=lambda r: (r[3], -r[2]))
+    else:
+        ok = [r for r in results if r[3] >= target] or [max(results, key=lambda r: r[3])]
+        suf, level, ratio, speed = min(ok, key=lambda r: (r[2], -r[3]))
+    if args.verbosity:
+        print('{}: chose {} -{} (ratio {:.3f}, {:.1f}MB/s on {:.1f}M sample)'.format(
+            args.min_throughput or args.profile, suf, level, ratio, speed, len(data) / 1024 / 1024),
+            file=sys.stderr)
+    return suf, level
+
+
+def apply_profile(args):
+    """
+    Fill args.format and args.level by sampling the inputs.
+    """
+    fmt = args.format
+    if fmt is None and args.archive is not None:
+        fmt = get_format_by_filename(args.archive)
+    sufs = None
+    if fmt is not None:
+        fmt = format_normalize(fmt)
+        suf = fmt.split('.')[-1]
+        if suf not in suf2filter:
+            return      # level of zip, 7z, rar is not tuned
+        sufs = {suf}
+    choice = choose_codec(args, sufs)
+    if choice is None:
+        return
+    suf, level = choice
+    if fmt is None:
+        if len(args.inputs) == 1 and not os.path.isdir(args.inputs[0]):
+            args.format = suf
+        else:
+            args.format = 'tar.' + suf
+    if args.level is None:
+        args.level = level
+## end profile*
+
+
+def dry_run_patch():
+    global run_cmd, run_builtin, run_records, run_metered, run_replay, ensure_output_dir
+    run_cmd = run_cmd_dry
+    run_metered = run_metered_dry
+    run_replay = run_replay_dry
+    run_records = run_records_dry
+    run_builtin = run_builtin_dry
+    ensure_output_dir = ensure_output_dir_dry
+
+
+def add_common_options(parser):
+    parser.add_argument("-v", "--verbosity", action="count", default=0,
+                        help="increase output verbosity")
+    parser.add_argument('--password', '--passwd', '-p', help='specify password for archive')
+    parser.add_argument('--extra-opt', help='extra options passed to the packer')
+    parser.add_argument('--packer',
+                        choices={'rar', 'winrar', 'unrar', '7z', '7zr', 'zip', 'unzip', 'tar',
+                                 'gzip', 'bzip2', 'xz', 'lzma', 'lzip', 'lzop', 'zstd', 'lz4', 'builtin'},
+                        help='specify packer')
+    parser.add_argument('--format', '-f', help='specify archive format')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='do not use cached archive identification')
+    parser.add_argument('--jobs', '-j', type=int, metavar='N', default=1,
+                        help='number of files processed concurrently')
+    parser.add_argument('--threads', '-T', type=int, metavar='N', default=os.cpu_count() or 1,
+                        help='number of threads used by compressor, default to number of cpus')
+    parser.add_argument('--level', '-L', type=int, metavar='N', help='compression level')
+    parser.add_argument('--long', type=int, metavar='WINDOW_LOG', nargs='?', const=27,
+                        help='zstd long distance matching')
+    parser.add_argument('--train-dict', action='store_true',
+                        help='train a zstd dictionary on INPUTS and compress with it')
+    parser.add_argument('--dict', metavar='FILE', help='zstd dictionary')
+    parser.add_argument('--progress', action='store_true',
+                        help='report bytes in and out, speed, ratio and ETA to stderr')
+    parser.add_argument('--stats-file', metavar='FILE', help='write bytes in and out, speed and ratio as json')
+    # --dry-run option was not handled here, it is handled in help_tester in main()
+    parser.add_argument('--dry-run', '--simulate', help='do not run the command', dest='dry_run',
+                        action='store_true')
+    return parser
+
+
+# packer file1 [file2]... [--to output] [--format tgz]
+def make_pack_parser(app):
+    parser = SilentArgumentParser(prog=app, add_help=False, description='compress files.\n'
+                                  'examples:\n'
+                                  '    packer 1.txt 2.txt --to archive.7z\n'
+                                  '    packer dir/ --format=tar.gz                   # got dir.tar.gz\n'
+                                  '    packer 1.txt 2.txt --format gz                # got 1.txt.gz, 2.txt.gz\n'
+                                  '    cat file | packer - --format xz > file.xz     # read from stdin\n'
+                                  '\n')
+    parser.add_argument('inputs', nargs='+')
+    parser.add_argument('--to', metavar='ARCHIVE', dest='archive')
+    for profile in profile_throughput:
+        parser.add_argument('--' + profile, dest='profile', action='store_const', const=profile)
+    parser.add_argument('--min-throughput', metavar='SPEED')
+    parser.add_argument('--sample-time', type=float, metavar='SECONDS', default=2)
+    parser.add_argument('--seekable', action='store_true')
+    parser.add_argument('--dedup', action='store_true')
+    return add_common_options(parser)
+
+
+def run_pack(parser, args):
+    if args.profile is not None or args.min_throughput is not None:
+        try:
+            apply_profile(args)
+        except ValueError as e:
+            parser.user_error(str(e))
+            return 1
+
+    # do furer check on options
+    if args.format is None and args.archive is None:
+        parser.user_error('you must specify --to or --format')
+        return 1
+
+    if args.format is None:
+        # guess format by archive name
+        args.format = get_format_by_filename(args.archive)
+        if args.format is None:
+            parser.user_error('could not determine archive type, '
+                          'add --format option or use proper extension in --to')
+            return 1
+    else:
+        if args.format in filter_type:
+            if args.archive is not None:
+                if len(args.inputs) > 1:
+                    parser.user_error('too many INPUTS')
+                    return 1
+
+    if args.archive is None:
+        if len(args.inputs) == 1:
+            # guess archive name by input file name
+            if args.inputs[0] == '-':
+                args.archive = '-'
+            else:
+                args.archive = os.path.normpath(args.inputs[0]) + '.' + args.format
+        else:
+            if args.format not in filter_type:
+                # guess archive name by cwd
+                cwd = os.getcwd()
+                cwd = os.path.abspath(cwd)  # is this necessary?
+                archive = cwd.split(os.sep)[-1]
+                if archive == '':
+                    # we are at root directory
+                    parser.user_error('could not determine archive name, you must specify --to')
+                    return 1
+                archive += '.' + args.format
+                args.archive = archive
+
+    args.format = format_normalize(args.format)
+    return pack(args)
+
+
+# packer -x archive --to dir/
+def make_unpack_parser(app):
+    parser = SilentArgumentParser(prog=app, add_help=False, description='decompress archive.\n'
+                                  'examples:\n'
+                                  '    packer -x archive.tgz\n'
+                                  '    packer -x archive.7z --to directory/\n'
+                                  '    packer -x archive.gz --to -    # write contents of archive.gz to stdout\n'
+                                  '    curl -s URL | packer -x - --to dir/    # format is identified from stdin\n'
+                                  '    packer -x a.tgz b.zip --jobs 4 --to dir/      # got dir/a/, dir/b/\n'
+                                  '\n')
+    parser.add_argument('-x', '--extract', metavar='ARCHIVE', required=True, dest='archive', nargs='+')
+    parser.add_argument('--to', metavar='OUTPUT', required=False, dest='output')
+    parser.add_argument('--io-jobs', type=int, metavar='N',
+                        help='max number of archives extracted concurrently from the same device')
+    parser.add_argument('--member', '-m', metavar='GLOB', action='append',
+                        help='extract members matching GLOB only')
+    return add_common_options(parser)
+
+
+def run_unpack(parser, args):
+    if len(args.archive) == 1:
+        args.archive = args.archive[0]
+        return unpack(args)
+    if args.output == '-':
+        parser.user_error('can not extract multiple archives to stdout')
+        return 1
+    return unpack_many(args)
+
+
+# packer [--test] --list archive
+def make_view_parser(app):
+    parser = SilentArgumentParser(prog=app, add_help=False, description='list archive contents, test archive')
+    parser.add_argument('--test', '-t', action='store_true')
+    parser.add_argument('--list', '-l', metavar='ARCHIVE', required=True, dest='archive', nargs='+')
+    parser.add_argument('--format-output', choices=['json', 'jsonl', 'csv'])
+    return add_common_options(parser)
+
+
+def run_view(parser, args):
+    if args.test and not args.dry_run and args.packer in {None, 'builtin'}:
+        return test_archives(args)
+    if len(args.archive) == 1:
+        args.archive = args.archive[0]
+        return view(args)
+    import copy
+    retcodes = []
+    for archive in args.archive:
+        job = copy.copy(args)
+        job.archive = archive
+        retcodes.append(view(job))
+    return report_failures(args.archive, retcodes)
+
+
+# packer --convert archive --to archive
+def make_convert_parser(app):
+    parser = SilentArgumentParser(prog=app, add_help=False, description='convert archive to tar, tar.*.\n'
+                                  'examples:\n'
+                                  '    packer --convert archive.tar.bz2 --to archive.tar.xz\n'
+                                  '    packer --convert archive.zip --to archive.tar.gz\n'
+                                  '\n')
+    parser.add_argument('--convert', metavar='ARCHIVE', required=True, dest='archive')
+    parser.add_argument('--to', metavar='OUTPUT', required=True, dest='output')
+    return add_common_options(parser)
+
+
+def run_convert(parser, args):
+    if get_format_by_filename(args.output) not in tar_type:
+        parser.user_error('could not determine output type, use tar, tar.* extension in --to')
+        return 1
+    return convert(args)
+
+
+# packer --update archive file1 [file2]...
+def make_update_parser(app):
+    parser = SilentArgumentParser(prog=app, add_help=False, description='add new and changed files to archive.\n'
+                                  'examples:\n'
+                                  '    packer --update archive.7z dir/\n'
+                                  '\n')
+    parser.add_argument('inputs', nargs='+')
+    parser.add_argument('--update', '-u', metavar='ARCHIVE', required=True, dest='archive')
+    return add_common_options(parser)
+
+
+def run_update(parser, args):
+    return update(args)
+
+
+# packer --benchmark [corpus]
+def make_benchmark_parser(app):
+    parser = SilentArgumentParser(prog=app, add_help=False, description='benchmark formats and packers.\n'
+                                  'examples:\n'
+                                  '    packer --benchmark --to result.json\n'
+                                  '    packer --benchmark dataset/ --formats tar.gz,tar.zst --levels 1,9\n'
+                                  '    packer --benchmark --compare result.json\n'
+                                  '\n')
+    parser.add_argument('--benchmark', metavar='CORPUS', nargs='?', const=None, dest='corpus', required=True)
+    parser.add_argument('--to', metavar='RESULT', dest='output')
+    parser.add_argument('--compare', metavar='RESULT')
+    parser.add_argument('--formats', help='comma separated formats')
+    parser.add_argument('--levels', help='comma separated compression levels')
+    parser.add_argument('--corpus-size', type=int, metavar='MB', default=32)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, metavar='N', default=1, help='keep the best of N runs')
+    return add_common_options(parser)
+
+
+def run_benchmark(parser, args):
+    return benchmark(args)
+
+
+# packer --tools
+def make_tools_parser(app):
+    parser = SilentArgumentParser(prog=app, add_help=False, description='show installed tools')
+    parser.add_argument('--tools', action='store_true', required=True)
+    return add_common_options(parser)
+
+
+def run_tools(parser, args):
+    return print_tools(args)
+
+
+# packer --serve SOCKET
+def make_serve_parser(app):
+    parser = SilentArgumentParser(prog=app, add_help=False, description='run requests of clients on a unix socket.\n'
+                                  'examples:\n'
+                                  '    packer --serve /run/packer.sock --jobs 8\n'
+                                  '    PACKER_SOCKET=/run/packer.sock packer -x archive.tgz\n'
+                                  '\n')
+    parser.add_argument('--serve', metavar='SOCKET', required=True, dest='socket')
+    add_common_options(parser)
+    parser.set_defaults(jobs=os.cpu_count() or 1)
+    return parser
+
+
+def run_serve(parser, args):
+    return serve(args)
+
+
+# (options that select the mode, make parser, run), parsers are tried in this order
+modes = [
+    ((), make_pack_parser, run_pack),
+    (('-x', '--extract'), make_unpack_parser, run_unpack),
+    (('-l', '--list'), make_view_parser, run_view),
+    (('--convert',), make_convert_parser, run_convert),
+    (('-u', '--update'), make_update_parser, run_update),
+    (('--benchmark',), make_benchmark_parser, run_benchmark),
+    (('--tools',), make_tools_parser, run_tools),
+    (('--serve',), make_serve_parser, run_serve),
+]
+
+
+def guess_modes(argv):
+    """
+    Cheap pre-scan of argv, so that only the parser of the mode requested is built in most cases.
+    Return modes ordered by likelihood.
+    """
+    opts = set()
+    for x in argv:
+        if x == '--':
+            break
+        if x.startswith('-'):
+            opts.add(x.split('=', 1)[0])
+    likely = [m for m in modes if opts.intersection(m[0])]
+    return likely + [m for m in modes if m not in likely]
+
+
+def main():
+    origin = time.perf_counter()
+    argv = sys.argv.copy()
+    app = argv[0].rsplit(os.path.sep, maxsplit=1)[-1]
+    argv_body = argv[1:]
+
+    # --client=SOCKET or PACKER_SOCKET runs the command in a server started by --serve,
+    # without the server the command is run here
+    client = [x for x in argv_body if x.startswith('--client=')]
+    if client:
+        argv_body = [x for x in argv_body if x not in client]
+    path = client[-1].partition('=')[2] if client else os.environ.get('PACKER_SOCKET')
+    if path and '--serve' not in argv_body:
+        ret = run_client(path, app, argv_body)
+        if ret is not None:
+            return ret
+        if client:
+            print('{}: no server on {}, running locally'.format(app, path), file=sys.stderr)
+    return run_argv(app, argv_body, origin)
+
+
+def run_argv(app, argv_body, origin):
+    # --timings[=TRACE] is taken out before parsing, only the = form is accepted,
+    # so that it does not take the next argument as its value
+    timings = [x for x in argv_body if x == '--timings' or x.startswith('--timings=')]
+    if timings:
+        argv_body = [x for x in argv_body if x not in timings]
+        tracer = timings_patch(origin)
+        try:
+            return tracer.phase(run_main, 'main')(app, argv_body)
+        finally:
+            trace_file = timings[-1].partition('=')[2]
+            if trace_file:
+                tracer.save(trace_file)
+            else:
+                tracer.print_summary()
+    return run_main(app, argv_body)
+
+
+def run_main(app, argv_body):
+    # print help and exit if -h in options
+    help_tester = SilentArgumentParser(add_help=False)
+    help_tester.add_argument('-h', '--help', help='show all help', dest='help', nargs='?', const='cmd')
+    # --dry-run option was handled here
+    help_tester.add_argument('--dry-run', '--simulate', help='do not run the command', dest='dry_run',
+                             action='store_true')
+    parse = help_tester.parse_known_args
+    if tracer is not None:
+        parse = tracer.phase(parse, 'argparse')
+    args, unknown = parse(argv_body)
+    if args.help == 'cmd':
+        print_help(app)
+        return 0
+    elif args.help == 'markdown':
+        fill_doc_string()
+        print(__doc__)
+        return 0
+
+    if args.dry_run:
+        dry_run_patch()
+
+    for _, make_parser, run in guess_modes(argv_body):
+        parser = make_parser(app)
+        parse = parser.parse_args
+        if tracer is not None:
+            parse = tracer.phase(parse, 'argparse ' + make_parser.__name__)
+            run = tracer.phase(run, run.__name__)
+        try:
+            args = parse(argv_body)
+        except ParseError:
+            # try next parser
+            continue
+        else:
+            return run(parser, args)
+
+    # all parsers fail to parse, print usage and exit
+    print_usage(app)
+    print('Run `{} --help=markdown` to see full documentation.'.format(app))
+    return 1
+